@@ -3,51 +3,427 @@ import cv2
 import random
 import os
 import glob
+import io
+import json
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# 画像のヘッダーだけを読んで (幅, 高さ) を返す　読めない形式ならNone
+# JPEG・TIFFはcv2.imreadと同じくExif（TIFFタグ）の回転を反映した大きさにする
+def read_size(filename):
+    with open(filename, "rb") as f:
+        head = f.read(30)
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head[:2] == b"BM":
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height)
+        if head[:2] == b"\xff\xd8":
+            f.seek(2)
+            return read_jpeg_size(f)
+        if head[:4] in (b"II*\x00", b"MM\x00*"):
+            tags = read_tiff_tags(f, 0)
+            if 0x0100 in tags and 0x0101 in tags:
+                return oriented(tags[0x0100], tags[0x0101], tags.get(0x0112, 1))
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return read_webp_size(head)
+    return None
+
+# 向きのタグが5～8なら90度回転している
+def oriented(width, height, orientation):
+    return (height, width) if orientation >= 5 else (width, height)
+
+def read_jpeg_size(f):
+    orientation = 1
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker[1] == 0xE1:
+            segment = f.read(length - 2)
+            if segment[:6] == b"Exif\x00\x00":
+                orientation = read_tiff_tags(io.BytesIO(segment), 6).get(0x0112, 1)
+        elif 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">xHH", f.read(5))
+            return oriented(width, height, orientation)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+# TIFFヘッダー（ファイルのbaseの位置）から最初のIFDを読み、SHORT・LONGのタグを {タグ: 値} で返す
+def read_tiff_tags(f, base):
+    tags = {}
+    try:
+        f.seek(base)
+        head = f.read(8)
+        order = "<" if head[:2] == b"II" else ">"
+        offset = struct.unpack(order + "I", head[4:8])[0]
+        f.seek(base + offset)
+        count = struct.unpack(order + "H", f.read(2))[0]
+        entries = f.read(12 * count)
+        for i in range(count):
+            tag, kind, _, value = struct.unpack(order + "HHI4s", entries[12*i : 12*(i+1)])
+            if kind == 3:       # SHORT
+                tags[tag] = struct.unpack(order + "H", value[:2])[0]
+            elif kind == 4:     # LONG
+                tags[tag] = struct.unpack(order + "I", value)[0]
+    except struct.error:
+        pass
+    return tags
+
+def read_webp_size(head):
+    chunk = head[12:16]
+    if chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":     # 非可逆
+        width, height = struct.unpack("<HH", head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and head[20] == 0x2F:                      # 可逆
+        bits = struct.unpack("<I", head[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":                                            # 拡張形式
+        return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+    return None
+
+# デコードした画像のLRUキャッシュ　枚数かバイト数の上限を超えたら古いものから捨てる
+class ImageCache():
+    def __init__(self, max_count=16, max_bytes=None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.pending = {}       # 先読み中のファイル名とFuture
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, filename):
+        with self.lock:
+            if filename in self.images:
+                self.images.move_to_end(filename)
+                return self.images[filename]
+            future = self.pending.get(filename)
+        if future is not None:
+            return future.result()
+        return self.load(filename)
+
+    def load(self, filename):
+        image = cv2.imread(filename)
+        with self.lock:
+            self.pending.pop(filename, None)
+            if image is None or filename in self.images:
+                return self.images.get(filename, image)
+            self.images[filename] = image
+            self.nbytes += image.nbytes
+            # 今読んだ1枚は残す
+            while len(self.images) > 1 and ((self.max_count and len(self.images) > self.max_count) or
+                                            (self.max_bytes and self.nbytes > self.max_bytes)):
+                _, old = self.images.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return image
+
+    # 別スレッドで先にデコードしておく
+    def prefetch(self, filenames):
+        with self.lock:
+            for filename in filenames:
+                if filename not in self.images and filename not in self.pending:
+                    self.pending[filename] = self.executor.submit(self.load, filename)
 
 class ImageObject():
-    def __init__(self, filename):
+    def __init__(self, filename, cache):
         self.filename = filename
-        self.image = cv2.imread(self.filename)
-        self.height, self.width = self.image.shape[:2]
+        self.cache = cache
+        self.size = None        # (幅, 高さ)　表示するときに初めて調べる
         self.has_roi = False
         self.pos = [(0,0) for _ in range(4)]
         self.pos_cnt = 0
 
+    # 大きさはヘッダーから読み、読めない形式のときだけデコードする
+    def get_size(self):
+        if self.size is None:
+            self.size = read_size(self.filename) or self.image.shape[1::-1]
+        return self.size
+
+    @property
+    def width(self):
+        return self.get_size()[0]
+
+    @property
+    def height(self):
+        return self.get_size()[1]
+
+    # 画素は使うときにキャッシュから取り出す
+    @property
+    def image(self):
+        return self.cache.get(self.filename)
+
+# 2点で決まる矩形の幅と高さ
+def roi_size(pos2, pos3):
+    return abs(pos3[0] - pos2[0]), abs(pos3[1] - pos2[1])
+
+def print_progress(done, total, filename, error):
+    count = f"{done}/{total}" if total else f"{done}"
+    if error is None:
+        print(f"[{count}] {filename}")
+    else:
+        print(f"[{count}] {filename} エラー: {error}")
+
+# 切り出し画像の書き出し
+# 読み込み・変形・エンコードと書き込みを1枚ずつスレッドプールで並列に行う（OpenCVの処理中はGILが外れる）
+# 処理待ちの枚数をmax_pendingまでに抑えるので、枚数が多くてもメモリは増えない
+class Exporter():
+    def __init__(self, width, height, workers=None, ext=None, quality=None, png_compression=None, prefix="trim_"):
+        self.width = width
+        self.height = height
+        self.workers = workers or os.cpu_count()
+        self.max_pending = 2 * self.workers
+        self.ext = ext                  # 出力形式の拡張子 ".jpg" ".png" ".webp" など　Noneなら元と同じ
+        self.quality = quality          # JPEG・WebPの品質　NoneならOpenCVの既定値
+        self.png_compression = png_compression
+        self.prefix = prefix
+        self.pts2 = np.float32([(0,0), (width,height), (width,0)])
+
+    def output_path(self, filename):
+        path, filename = os.path.split(filename)
+        if self.ext is not None:
+            filename = os.path.splitext(filename)[0] + self.ext
+        return os.path.join(path, self.prefix + filename)
+
+    def encode_params(self, filename):
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in (".jpg", ".jpeg") and self.quality is not None:
+            return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        if ext == ".webp" and self.quality is not None:
+            return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        if ext == ".png" and self.png_compression is not None:
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        return []
+
+    # 矩形pos2-pos3を (width, height) に変形する
+    def crop(self, image, pos2, pos3):
+        x2, y2 = min(pos2[0], pos3[0]), min(pos2[1], pos3[1])
+        x3, y3 = max(pos2[0], pos3[0]), max(pos2[1], pos3[1])
+        pos4 = (x3, y2)
+        pts1 = np.float32([pos2, pos3, pos4])
+        M = cv2.getAffineTransform(pts1, self.pts2)
+        result = self.crop_resize(image, M)
+        if result is not None:
+            return result
+        return cv2.warpAffine(image, M, (self.width, self.height), borderValue=(255,255,255))
+
+    # 回転も反転もない（拡大縮小と平行移動だけの）変換なら、スライスのビューをリサイズするだけで済む
+    # 画像からはみ出すときや斜めの変換はNoneを返し、warpAffineに任せる
+    def crop_resize(self, image, M):
+        (sx, shx, tx), (shy, sy, ty) = M
+        if abs(shx) > 1e-9 or abs(shy) > 1e-9 or sx <= 0 or sy <= 0:
+            return None
+        # 出力の (0,0)-(width,height) に写る元画像の矩形
+        left, top = -tx / sx, -ty / sy
+        right, bottom = (self.width - tx) / sx, (self.height - ty) / sy
+        rect = np.round([left, top, right, bottom])
+        if np.abs(rect - [left, top, right, bottom]).max() > 1e-3:
+            return None
+        left, top, right, bottom = rect.astype(int)
+        if left < 0 or top < 0 or right > image.shape[1] or bottom > image.shape[0] or left == right or top == bottom:
+            return None
+        view = image[top:bottom, left:right]
+        if view.shape[1::-1] == (self.width, self.height):
+            return view.copy()
+        shrink = self.width * self.height < view.shape[0] * view.shape[1]
+        return cv2.resize(view, (self.width, self.height), interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+
+    # 1枚分　書き出したファイル名を返す
+    def export(self, filename, pos2, pos3):
+        image = cv2.imread(filename)
+        if image is None:
+            raise IOError("画像を読み込めません")
+        result = self.crop(image, pos2, pos3)
+        new_filename = self.output_path(filename)
+        if not cv2.imwrite(new_filename, result, self.encode_params(new_filename)):
+            raise IOError("書き込めません")
+        return new_filename
+
+    # jobsは (ファイル名, pos2, pos3) の並び　1枚終わるごとにprogress(終わった枚数, 全体の枚数, ファイル名, エラー)を呼ぶ
+    # エラーになった (ファイル名, 例外) のリストを返す
+    def run(self, jobs, total=None, progress=print_progress):
+        errors = []
+        done = 0
+        slots = threading.BoundedSemaphore(self.max_pending)
+        lock = threading.Lock()
+
+        def finished(future, filename):
+            nonlocal done
+            error = future.exception()
+            try:
+                with lock:
+                    done += 1
+                    if error is not None:
+                        errors.append((filename, error))
+                    if progress is not None:
+                        try:
+                            progress(done, total, filename, error)
+                        except Exception as e:     # 表示のエラーも書き出しのエラーと同じように返す
+                            errors.append((filename, e))
+            finally:
+                slots.release()     # 必ず返さないと、次の画像を投入できずに止まる
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for filename, pos2, pos3 in jobs:
+                slots.acquire()
+                future = executor.submit(self.export, filename, pos2, pos3)
+                future.add_done_callback(lambda future, filename=filename: finished(future, filename))
+        return errors
+
+IMAGE_EXTS = {".bmp", ".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"}
+
+# ROIのセッションファイル（JSON）
+# 画像はファイル名（ディレクトリを除く）で対応づける
+def read_session(filename):
+    with open(filename, encoding="utf-8") as f:
+        session = json.load(f)
+    for roi in session["images"].values():
+        roi["pos"] = [tuple(pos) for pos in roi["pos"]]
+    return session
+
+# セッションのROIをディレクトリの画像に当てはめて (ファイル名, pos2, pos3) を1つずつ返す
+# ROIのない画像は、use_masterならマスターと同じ位置で切り出し、そうでなければ飛ばす
+def session_jobs(directory, session, use_master=False, prefix="trim_"):
+    master = session["images"][session["master"]]["pos"]
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            name = entry.name
+            if not entry.is_file() or name.startswith(prefix) or os.path.splitext(name)[1].lower() not in IMAGE_EXTS:
+                continue
+            roi = session["images"].get(name)
+            if roi is not None and roi["has_roi"]:
+                yield entry.path, roi["pos"][2], roi["pos"][3]
+            elif use_master:
+                yield entry.path, master[2], master[3]
+
+# ウィンドウを開かずにセッションのROIでディレクトリの画像を書き出す
+# ファイルは1枚ずつ流すので、画像の枚数が多くてもメモリは増えない
+def batch(directory, session_file, use_master=False, workers=None, ext=None, quality=None, png_compression=None,
+          progress=print_progress):
+    session = read_session(session_file)
+    if session["master"] is None:
+        raise ValueError("セッションにマスターのROIがありません")
+    _, _, pos2, pos3 = session["images"][session["master"]]["pos"]
+    width, height = roi_size(pos2, pos3)
+    exporter = Exporter(width, height, workers, ext, quality, png_compression)
+    return exporter.run(session_jobs(directory, session, use_master, exporter.prefix), None, progress)
+
 class App():
-    def __init__(self, path):
+    def __init__(self, path, cache_count=16, cache_bytes=None, session=None, display_size=(1600, 900)):
         self.files = glob.glob(path)
-        self.objects = [ImageObject(file) for file in self.files]
+        self.cache = ImageCache(cache_count, cache_bytes)
+        self.objects = [ImageObject(file, self.cache) for file in self.files]
         self.roi_cnt = 0
         self.index = 0
         self.aspect_ratio = 1
         self.master_index = None
         self.mx, self.my = 0, 0
+        self.display_size = display_size    # 表示する画像の最大の (幅, 高さ)
+        self.proxies = OrderedDict()        # 表示用に縮小した画像
+        self.dirty = True                   # Trueのときだけshow()で描き直す
+        if session is not None and os.path.exists(session):
+            self.load_session(session)
         self.winname = "image"
         cv2.namedWindow(self.winname)
         cv2.setMouseCallback(self.winname, self.mouse_event)
+        self.prefetch()
+
+    def save_session(self, filename):
+        master = self.objects[self.master_index] if self.master_index is not None else None
+        session = {
+            "master": os.path.basename(master.filename) if master else None,
+            "aspect_ratio": self.aspect_ratio,
+            "images": {os.path.basename(obj.filename): {"pos": obj.pos, "pos_cnt": obj.pos_cnt, "has_roi": obj.has_roi}
+                       for obj in self.objects if obj.pos_cnt == 4},
+        }
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(session, f, indent=2, ensure_ascii=False)
+
+    def load_session(self, filename):
+        session = read_session(filename)
+        self.aspect_ratio = session["aspect_ratio"]
+        self.master_index = None
+        self.roi_cnt = 0
+        for i, obj in enumerate(self.objects):
+            name = os.path.basename(obj.filename)
+            roi = session["images"].get(name)
+            if roi is None:
+                continue
+            obj.pos = list(roi["pos"])
+            obj.pos_cnt = roi["pos_cnt"]
+            obj.has_roi = roi["has_roi"]
+            if obj.has_roi:
+                self.roi_cnt += 1
+            if name == session["master"]:
+                self.master_index = i
+        self.dirty = True
+
+    # 元画像の座標に掛けると表示の座標になる倍率
+    def display_scale(self, obj):
+        return min(1, self.display_size[0] / obj.width, self.display_size[1] / obj.height)
 
+    # 表示用の縮小画像　直近の数枚だけ残す
+    def proxy(self, obj):
+        if obj.filename in self.proxies:
+            self.proxies.move_to_end(obj.filename)
+            return self.proxies[obj.filename]
+        scale = self.display_scale(obj)
+        image = obj.image
+        if scale < 1:
+            size = (max(1, round(obj.width * scale)), max(1, round(obj.height * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        self.proxies[obj.filename] = image
+        if len(self.proxies) > 4:
+            self.proxies.popitem(last=False)
+        return image
+
+    # マウスやキーで何かが変わったときだけ、縮小画像に描き直す
     def show(self):
+        if not self.dirty:
+            return
+        self.dirty = False
         obj = self.objects[self.index]
-        img = obj.image.copy()
+        scale = self.display_scale(obj)
+        img = self.proxy(obj).copy()
         color = tuple(random.randint(0, 255) for _ in range(3))
 
+        def to_display(pos):
+            return (int(pos[0] * scale), int(pos[1] * scale))
+
+        mx, my = to_display((self.mx, self.my))
         for i in [0, 1]:
             pos1, pos2 = obj.pos[2*i : 2*(i+1)]
             if pos1 == pos2:
                 if not obj.has_roi:
-                    cv2.line(img, (self.mx, 0), (self.mx, obj.height), color, 1)
-                    cv2.line(img, (0, self.my), (obj.width, self.my), color, 1)
+                    cv2.line(img, (mx, 0), (mx, img.shape[0]), color, 1)
+                    cv2.line(img, (0, my), (img.shape[1], my), color, 1)
             else:
-                cv2.rectangle(img, pos1, pos2, color, i+1)
+                cv2.rectangle(img, to_display(pos1), to_display(pos2), color, i+1)
 
         cv2.imshow(self.winname, img)
 
     def update_index(self, k=0):
         self.index = (self.index + k) % len(self.files)
+        self.dirty = True
+        self.prefetch()
 
+    # 前後の画像を先読みする
+    def prefetch(self):
+        n = len(self.files)
+        self.cache.prefetch([self.files[(self.index + 1) % n], self.files[(self.index - 1) % n]])
+
+    # x, yは表示の座標なので、元画像の座標に直してからROIを計算する
     def mouse_event(self, event, x, y, flags, param):
-        self.mx, self.my = x, y
         obj = self.objects[self.index]
+        scale = self.display_scale(obj)
+        x, y = int(x / scale), int(y / scale)
+        self.mx, self.my = x, y
+        self.dirty = True
 
         if obj.pos_cnt == 0:
             obj.pos[0] = (x, y)
@@ -112,28 +488,14 @@ class App():
             obj.pos = [(0,0) for _ in range(4)]
             obj.pos_cnt = 0
 
-    def output(self):
+    # ROIを決めた画像を切り出して保存する　エラーになった (ファイル名, 例外) のリストを返す
+    def output(self, workers=None, ext=None, quality=None, png_compression=None, progress=print_progress):
         _, _, pos2, pos3 = self.objects[self.master_index].pos
-        x2, y2 = min(pos2[0], pos3[0]), min(pos2[1], pos3[1])
-        x3, y3 = max(pos2[0], pos3[0]), max(pos2[1], pos3[1])
-        width = x3 - x2
-        height = y3 - y2
-        pts2 = np.float32([(0,0), (width,height), (width,0)])
+        width, height = roi_size(pos2, pos3)
+        exporter = Exporter(width, height, workers, ext, quality, png_compression)
+        jobs = [(obj.filename, obj.pos[2], obj.pos[3]) for obj in self.objects if obj.has_roi]
+        return exporter.run(jobs, len(jobs), progress)
 
-        for obj in self.objects:
-            if obj.has_roi:
-                _, _, pos2, pos3 = obj.pos
-                x2, y2 = min(pos2[0], pos3[0]), min(pos2[1], pos3[1])
-                x3, y3 = max(pos2[0], pos3[0]), max(pos2[1], pos3[1])
-                pos4 = (x3, y2)
-                pts1 = np.float32([pos2, pos3, pos4])
-                M = cv2.getAffineTransform(pts1, pts2)
-                result = cv2.warpAffine(obj.image.copy(), M, (width, height), borderValue=(255,255,255))
-                path, filename = os.path.split(obj.filename)
-                new_filename = "trim_" + filename
-                print(new_filename)
-                cv2.imwrite(os.path.join(path, new_filename), result)
-                
         """
         _, _, pos2, pos3 = self.objects[self.master_index].pos
         width = int(pos3[0] - pos2[0])
@@ -154,8 +516,24 @@ class App():
         """
 
 def main():
-    path = f"./images/*"
-    app = App(path)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", default="./images/*", help="画像ファイルのパターン")
+    parser.add_argument("--session", default="sizesync.json", help="ROIのセッションファイル")
+    parser.add_argument("--batch", metavar="DIR", help="ウィンドウを開かず、セッションのROIでDIRの画像を書き出す")
+    parser.add_argument("--use-master", action="store_true", help="ROIのない画像もマスターと同じ位置で切り出す")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--ext", default=None, help="出力形式の拡張子（例: .jpg）")
+    parser.add_argument("--quality", type=int, default=None, help="JPEG・WebPの品質（省略時はOpenCVの既定値）")
+    parser.add_argument("--png-compression", type=int, default=None, help="PNGの圧縮レベル（省略時はOpenCVの既定値）")
+    args = parser.parse_args()
+
+    if args.batch:
+        errors = batch(args.batch, args.session, args.use_master, args.workers, args.ext, args.quality,
+                       args.png_compression)
+        raise SystemExit(1 if errors else 0)
+
+    app = App(args.images, session=args.session)
     while True:
         app.show()
         key = cv2.waitKey(1) & 0xFF
@@ -167,8 +545,11 @@ def main():
             app.update_index(1)
         elif key == ord("b"):       # b_ack
             app.update_index(-1)
+        elif key == ord("w"):       # w_rite session
+            app.save_session(args.session)
         elif key == ord("s"):       # s_ave
-            app.output()
+            app.save_session(args.session)
+            app.output(args.workers, args.ext, args.quality, args.png_compression)
             break
 
     cv2.destroyAllWindows()
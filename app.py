@@ -3,75 +3,145 @@ import numpy as np
 import math
 import random
 import time
+import heapq
+import sys
 
 class Sand():
+    __slots__ = ("char", "x", "y", "cnt", "on_ground", "color", "awake")
+
     def __init__(self, i, x, y):
         self.char = chr(i+65)       # Aから始まる
         self.x = x
         self.y = y
         self.cnt = i
         self.on_ground = False
+        self.awake = True           # Falseなら動けないので眠っている
         self.color = (random.randint(20, 255), random.randint(20, 255), random.randint(20, 255))
 
 class Field():
-    def __init__(self, angle):
+    def __init__(self, angle, width=32, height=32, unit=20):
+        self.width = width
+        self.height = height
+        self.unit = unit
+        self.matrix = [[None] * self.width for _ in range(self.height)]    # 各セルにいる砂粒（いなければNone）
+        self.newest = None          # 最後に出てきた砂粒
+        self.awake = []             # 次のフレームで動かす砂粒
+        self.dirty = set()          # 前回の描画から変わったセル (x, y)
+        self.set_angle(angle)
+
+        # 描画：フレームを使い回し、円のスプライト（マスク）を変わったセルにだけ押す
+        self.image = np.zeros((self.unit * self.height, self.unit * self.width, 3), np.uint8)
+        self.colors = np.zeros((self.height, self.width, 3), np.uint8)     # セルごとの色（空なら黒）
+        self.sprite = np.zeros((self.unit, self.unit, 1), np.uint8)
+        cv2.circle(self.sprite, (self.unit//2, self.unit//2), self.unit//2, 1, -1)
+        self.sprite_mask = np.tile(self.sprite[:, :, 0] * 255, (self.height, self.width))     # 全セル分のマスク
+        self.upscaled = np.zeros_like(self.image)
+
+    def __str__(self):
+        return  "\n".join([f"{r}: " + " ".join("_" if cell is None else cell.char for cell in row) for r, row in enumerate(self.matrix)]) + "\n   " + "="*2*self.width
+
+    def set_angle(self, angle):
         self.angle = angle
         self.gx = -math.sin(math.radians(self.angle))
         self.gy = math.cos(math.radians(self.angle))
-        self.width = 32
-        self.height = 32
-        self.unit = 20
+        # 真下・左下・右下の移動先のx座標はxだけ、y座標はyだけで決まるので表にしておく
+        xs, ys = range(self.width), range(self.height)
+        self.down = ([round(x + self.gx) for x in xs], [round(y + self.gy) for y in ys])
+        self.left = ([round(x + self.gx - self.gy) for x in xs], [round(y + self.gy - self.gx) for y in ys])
+        self.right = ([round(x + self.gx + self.gy) for x in xs], [round(y + self.gy + self.gx) for y in ys])
 
-    def __str__(self):
-        return  "\n".join([f"{r}: " + " ".join(map(str, row)) for r, row in enumerate(self.matrix)]) + "\n   " + "="*2*self.width
+        # 各セルを真下・左下・右下として支えにしているセルの一覧（空いたときに起こす砂粒を探す）
+        self.supported_by = [[[] for _ in xs] for _ in ys]
+        for py in ys:
+            for px in xs:
+                for tx, ty in (self.down, self.left, self.right):
+                    x, y = tx[px], ty[py]
+                    if 0 <= x < self.width and 0 <= y < self.height:
+                        self.supported_by[y][x].append((px, py))
+
+        # 重力の向きが変わったら全部起こす
+        self.awake = [cell for row in self.matrix for cell in row if cell is not None]
+        for sand in self.awake:
+            sand.awake = True
 
+    # 砂粒を置く　すでに埋まっていれば置かずにFalseを返す
+    def add_sand(self, sand:Sand):
+        if not self.is_movable(sand.x, sand.y):
+            return False
+        self.matrix[sand.y][sand.x] = sand
+        self.dirty.add((sand.x, sand.y))
+        if self.newest is not None:
+            self.newest.on_ground = False
+        self.newest = sand
+        sand.awake = True
+        self.awake.append(sand)
+        return True
+
+    # マトリックスを作り直す
     def apply(self, sands:list[Sand]):
-        self.matrix = [["_" for _ in range(self.width)] for _ in range(self.height)]
+        self.matrix = [[None] * self.width for _ in range(self.height)]
         for sand in sands:
-            x, y, char, color = sand.x, sand.y, sand.char, sand.color
-            self.matrix[y][x] = color
+            self.matrix[sand.y][sand.x] = sand
+            sand.awake = True
+        self.newest = max(sands, key=lambda x: x.cnt) if sands else None
+        self.awake = list(sands)
+        self.dirty = {(x, y) for y in range(self.height) for x in range(self.width)}
+
+    # 砂粒を動かし、空いたセルを支えにしていた眠っている砂粒を起こす
+    def move(self, sand:Sand, x, y, queue):
+        self.matrix[sand.y][sand.x] = None
+        for px, py in self.supported_by[sand.y][sand.x]:
+            other = self.matrix[py][px]
+            if other is not None and not other.awake:
+                other.awake = True
+                if other.cnt > sand.cnt:    # まだ順番が来ていなければこのフレームで動かす
+                    heapq.heappush(queue, (other.cnt, other))
+                else:
+                    self.awake.append(other)
+        self.matrix[y][x] = sand
+        self.dirty.add((sand.x, sand.y))
+        self.dirty.add((x, y))
+        sand.x, sand.y = x, y
 
-    def drop_sands(self, sands:list[Sand]):
-        for i, sand in enumerate(sands):
-            x, y, char = sand.x, sand.y, sand.char
+    # 起きている砂粒を古い順に1つずつ動かす　動いた砂粒はすぐにマトリックスに反映する
+    # 動けない砂粒は眠らせ、支えのセルが空くか重力の向きが変わったときだけ起こす
+    # （sandsは互換のために残している　起きている砂粒はFieldが管理する）
+    def drop_sands(self, sands:list[Sand]=None):
+        down_x, down_y = self.down
+        left_x, left_y = self.left
+        right_x, right_y = self.right
+        queue = [(sand.cnt, sand) for sand in self.awake]
+        heapq.heapify(queue)
+        self.awake = []
+        while queue:
+            _, sand = heapq.heappop(queue)
+            x, y = sand.x, sand.y
             # 真下と右下と左下
-            xu, yu = round(x + self.gx), round(y + self.gy)                         # 真下
-            xl, yl = round(x + self.gx - self.gy), round(y + self.gy - self.gx)     # 左下
-            xr, yr = round(x + self.gx + self.gy), round(y + self.gy + self.gx)     # 右下
+            xu, yu = down_x[x], down_y[y]       # 真下
+            xl, yl = left_x[x], left_y[y]       # 左下
+            xr, yr = right_x[x], right_y[y]     # 右下
 
             if self.is_movable(xu, yu):                             # 真下に動けるならば
-                sand.x, sand.y = xu, yu                             # 真下に移動
-            elif not self.is_movable(xr, yr) and not self.is_movable(xl, yl):   # 真下・右下・左下のすべてに動けなければ
-                sand.on_ground = True                                                            # 何もしない（動かない）
-            elif self.is_movable(xr, yr) and not self.is_movable(xl, yl):       # 右下のみ動けるならば
-                sand.x, sand.y = xr, yr
-            elif not self.is_movable(xr, yr) and self.is_movable(xl, yl):       # 左下のみ動けるならば
-                    sand.x, sand.y = xl, yl
-            elif self.is_movable(xr, yr) and self.is_movable(xl, yl):           # 右下左下両方に動けるならば
-                """
-                if sand.cnt == len(sands)-1:    # 最後の砂のとき注目
-                    pass
-                if self.matrix[yr][xr] == "_" and self.matrix[yl][xl] != "_":       # 右下だけが空白ならば
-                    sand.x, sand.y = xr, yr
-                elif self.matrix[yr][xr] != "_" and self.matrix[yl][xl] == "_":     # 左下だけが空白ならば
-                    sand.x, sand.y = xl, yl
-                elif self.matrix[yr][xr] != "_" and self.matrix[yl][xl] != "_":     # どちらも空白でなかったら
-                    sand.on_ground = True
-                else:                                                               # どちらも空白ならば
+                self.move(sand, xu, yu, queue)                      # 真下に移動
+            else:                                                   # 右下と左下は1回ずつだけ調べる
+                movable_r, movable_l = self.is_movable(xr, yr), self.is_movable(xl, yl)
+                if not movable_r and not movable_l:                 # 真下・右下・左下のすべてに動けなければ
+                    sand.on_ground = True                           # 何もしない（動かない）
+                    sand.awake = False                              # 支えが空くまで眠る
+                elif movable_r and not movable_l:                   # 右下のみ動けるならば
+                    self.move(sand, xr, yr, queue)
+                elif not movable_r and movable_l:                   # 左下のみ動けるならば
+                    self.move(sand, xl, yl, queue)
+                else:                                               # 右下左下両方に動けるならば
                     k = random.choice([0, 1])
-                    sand.x, sand.y = [xr, xl][k], [yr, yl][k]
-                """
-                k = random.choice([0, 1])
-                sand.x, sand.y = [xr, xl][k], [yr, yl][k]
-            else:
-                sand.on_ground = True
-            
+                    self.move(sand, [xr, xl][k], [yr, yl][k], queue)
+            if sand.awake:
+                self.awake.append(sand)
+
             # 接地フラグ（次の砂が出てくる）は、最後の一粒にのみ作用する　つまりそれ以外は動けなくてもFalseにする
-            if sand.cnt < max(sands, key=lambda x: x.cnt).cnt:
+            if sand is not self.newest:
                 sand.on_ground = False
 
-        self.apply(sands)
-
     def isin(self, x, y):
         # x,yがマトリックス内にあるかどうか
         """
@@ -81,7 +151,7 @@ class Field():
 
     def is_movable(self, x, y):
         if 0 <= x < self.width and 0 <= y < self.height:
-            if self.matrix[y][x] == "_":
+            if self.matrix[y][x] is None:
                 ret = True
             else:
                 ret = False
@@ -89,17 +159,34 @@ class Field():
             ret = False
         return ret
 
-    def draw(self):
-        image = np.full((self.unit * self.height, self.unit * self.width, 3), (0,0,0), np.uint8)
-        for r, row in enumerate(self.matrix):
-            y = int((r+0.5) * self.unit)
-            for c, cell in enumerate(row):
-                x = int((c + 0.5) * self.unit)
-                if cell != "_":
-                    cv2.circle(image, (x,y), self.unit//2, cell, -1)
+    # 前回から変わったセルだけを描き直したフレームを返す
+    def render(self):
+        if not self.dirty:
+            return self.image
+        for x, y in self.dirty:
+            cell = self.matrix[y][x]
+            self.colors[y, x] = (0,0,0) if cell is None else cell.color
+
+        u = self.unit
+        if len(self.dirty) * 16 > self.width * self.height:
+            # 多くのセルが変わったときは、色のグリッドを拡大してマスクで円を抜き出す
+            cv2.resize(self.colors, (self.width * u, self.height * u), dst=self.upscaled, interpolation=cv2.INTER_NEAREST)
+            cv2.bitwise_and(self.upscaled, self.upscaled, dst=self.image, mask=self.sprite_mask)
+        else:
+            for x, y in self.dirty:
+                np.multiply(self.sprite, self.colors[y, x], out=self.image[y*u:(y+1)*u, x*u:(x+1)*u])
+        self.dirty.clear()
+        return self.image
+
+    # recorderを渡すと描画した画像を録画する
+    def draw(self, recorder=None):
+        image = self.render()
+        if recorder is not None:
+            recorder.write(image)
         cv2.imshow("", image)
 
 def get_start_pos(gravity_angle, field:Field):
+    gravity_angle %= 360
     if gravity_angle == 0:              # 重力が下方向
         x0 = random.randint(0, field.width-1)
         y0 = 0
@@ -112,34 +199,122 @@ def get_start_pos(gravity_angle, field:Field):
     elif gravity_angle == 270:          # 重力が右方向
         x0 = 0
         y0 = random.randint(0, field.height-1)
-#    return x0, y0
-    return random.randint(0, field.width-1), 0
+    else:                               # 斜めのときは重力の上流側の2辺から、重力成分の大きさに比例して選ぶ
+        gx = -math.sin(math.radians(gravity_angle))
+        gy = math.cos(math.radians(gravity_angle))
+        if random.random() < abs(gy) / (abs(gx) + abs(gy)):
+            x0 = random.randint(0, field.width-1)
+            y0 = 0 if gy > 0 else field.height - 1
+        else:
+            x0 = 0 if gx > 0 else field.width - 1
+            y0 = random.randint(0, field.height-1)
+    return x0, y0
+
+class Emitter():
+    """
+    砂粒の発生源
+    rate: 1フレームあたりに出す砂粒の数（小数なら端数を持ち越す）
+    burst, interval: intervalフレームごとにburst個をまとめて出す
+    wait_ground: Trueなら最後の砂粒が接地するまで出さない（元の一粒ずつの動作）
+    pos: 出現位置 Noneなら重力の向きに応じてget_start_posで決める
+    """
+    def __init__(self, rate=1.0, burst=0, interval=0, wait_ground=False, pos=None):
+        self.rate = rate
+        self.burst = burst
+        self.interval = interval
+        self.wait_ground = wait_ground
+        self.pos = pos
+        self.stock = 0.0
+
+    # このフレームで出す砂粒の数
+    def count(self, frame, field:Field):
+        if self.wait_ground:
+            return 1 if field.newest is None or field.newest.on_ground else 0
+        self.stock += self.rate
+        n = int(self.stock)
+        self.stock -= n
+        if self.burst and self.interval and frame % self.interval == 0:
+            n += self.burst
+        return n
+
+    def start_pos(self, field:Field):
+        return self.pos if self.pos is not None else get_start_pos(field.angle, field)
+
+class Scheduler():
+    # 複数の発生源から毎フレーム砂粒を出す
+    def __init__(self, emitters:list[Emitter]):
+        self.emitters = emitters
+        self.frame = 0
+        self.cnt = 0            # 次の砂粒の通し番号
+        self.blocked = 0        # 出現位置が埋まっていて出せなかった数（直近のフレーム）
+
+    def update(self, field:Field, sands:list[Sand]):
+        self.blocked = 0
+        for emitter in self.emitters:
+            for _ in range(emitter.count(self.frame, field)):
+                x0, y0 = emitter.start_pos(field)
+                sand = Sand(self.cnt, x0, y0)
+                if field.add_sand(sand):        # 出現位置が埋まっていたら出さない
+                    self.cnt += 1
+                    sands.append(sand)
+                else:
+                    self.blocked += 1
+        self.frame += 1
 
-def main():
+# 画面を出さずにフィールドが埋まるまで進め、かかったフレーム数を返す
+# 起きている砂粒がなく、patienceフレーム続けて1粒も出せなかったら埋まったとみなす
+def fill(field:Field, scheduler:Scheduler, max_frames=100000, patience=50):
+    sands = []
+    stalled = 0
+    for frame in range(max_frames):
+        n = len(sands)
+        scheduler.update(field, sands)
+        field.drop_sands(sands)
+        stalled = stalled + 1 if len(sands) == n and scheduler.blocked and not field.awake else 0
+        if stalled >= patience:
+            return frame + 1, sands
+    return max_frames, sands
+
+def main(record=None):
     gravity_angle = 45
     field = Field(gravity_angle)
-    x0, y0 = get_start_pos(gravity_angle, field)
+    scheduler = Scheduler([Emitter(rate=0.5), Emitter(rate=0, burst=5, interval=30)])
+    recorder = None
+    if record:
+        from recorder import Recorder
+        recorder = Recorder(record)
 
-    i = 0
     sands = []
-    sands.append(Sand(i, x0, y0))
-    field.apply(sands)
-
     while True:
         # print(field)
-        if sands[-1].on_ground:
-            i += 1
-            x0, y0 = get_start_pos(gravity_angle, field)
-            sands.append(Sand(i, x0, y0))
-            # print(field)
+        scheduler.update(field, sands)
         field.drop_sands(sands)
-        field.draw()
+        field.draw(recorder)
         key = cv2.waitKey(1)
         if key == 27:
             break
 
+    if recorder is not None:
+        recorder.close()
     cv2.destroyAllWindows()
 
 
+# 一粒ずつ出す場合と連続して出す場合で、埋まるまでの時間を比べる
+def bench_fill():
+    for name, emitters in [("one at a time", [Emitter(wait_ground=True)]),
+                           ("rate=4", [Emitter(rate=4)]),
+                           ("rate=16 + burst", [Emitter(rate=16), Emitter(rate=0, burst=64, interval=10)])]:
+        random.seed(0)
+        field = Field(45)
+        t0 = time.perf_counter()
+        frames, sands = fill(field, Scheduler(emitters))
+        print(f"{name:16} {frames:6} frames {len(sands):5} grains {time.perf_counter() - t0:7.3f} s")
+
+
 if __name__ == "__main__":
-    main()
+    if "--bench" in sys.argv:
+        bench_fill()
+    elif "--record" in sys.argv:
+        main(sys.argv[sys.argv.index("--record") + 1])
+    else:
+        main()
@@ -1,24 +1,29 @@
 import numpy as np
 import cv2
 import random
-from time import sleep
-from collections import deque
+import sys
+import threading
+from time import sleep, perf_counter
 
 W = 16
 H = 16
 OWANIMO = 4
 COLORS = 4
+ERASED = -1     # ぷよが消える演出（画面では * と表示する）
 
 is_generate = True
 
 class Field():
-    def __init__(self):
+    def __init__(self, animate=False, incremental=True):
         self.clear()
         self.is_generate = True
         self.rensa = 0
+        self.animate = animate          # Trueなら表示用に1フレーム1行ずつ落とす
+        self.incremental = incremental  # Trueなら前回のぷよ消しチェックから変わったセルの周りだけ調べる
 
     def clear(self):
-        self.matrix = [[0] *W for h in range(H)]
+        self.matrix = np.zeros((H, W), dtype=np.int8)
+        self.changed = np.ones((H, W), dtype=bool)     # 前回のぷよ消しチェックから置かれた・動いたセル
 
     def print(self):
         texts = " "*20+"\n" if self.rensa==0 else f"   {self.rensa}連鎖{'!'*(self.rensa)}\n"
@@ -27,6 +32,8 @@ class Field():
             for cell in row:
                 if cell == 0:
                     texts += " "
+                elif cell == ERASED:
+                    texts += "\033[3*m*\033[0m"
                 else:
                     texts += f"\033[3{cell}m{cell}\033[0m"
             texts += "\n"
@@ -34,10 +41,6 @@ class Field():
         texts += "\033[F" * (H+2)   # 行の数だけカーソル上移動を繰り返す
         print(texts)
 
-        is_owanimo = any("*" in row for row in self.matrix)     # * があるかどうか
-        wait_time = 0.8 if is_owanimo else 0.001
-        sleep(wait_time)
-
     def generate_drop(self):
         # 全部埋まったとき＝最上段に0が一つもないときは一色が消える
         if not 0 in self.matrix[0]:
@@ -48,88 +51,415 @@ class Field():
                 c = random.randint(0, W-1)
                 if self.matrix[0][c] == 0:
                     self.matrix[0][c] = color
+                    self.changed[0][c] = True
                     break
         self.is_generate = False
         self.rensa = 0
 
+    # 落下　移動先のセルがTrueの配列（動いたぷよ）を返す
     def drop(self):
-        copy = [row[:] for row in self.matrix]
-        for r in reversed(range(H)):    # 下からチェック
-            for c in range(W):
-                # ぷよが消える演出の * を空白に戻す
-                if self.matrix[r][c] == "*":
-                    self.matrix[r][c] = 0
-
-                # 落下 最下行はこれより下に落ちないので評価しない
-                if r < H-1:
-                    if self.matrix[r+1][c] == 0:
-                        self.matrix[r+1][c] = self.matrix[r][c]
-                        self.matrix[r][c] = 0
-                else:
-                    pass
+        erased = self.matrix == ERASED
+        self.matrix[erased] = 0             # ぷよが消える演出の * を空白に戻す
+        moved = self.fall_one_row() if self.animate else self.compact()
+        self.changed |= moved
 
-        if copy == self.matrix:             # マトリックスが変わっていない　つまりこれ以上動かないならば
+        if not erased.any() and not moved.any():    # マトリックスが変わっていない　つまりこれ以上動かないならば
             is_erase = self.erase()         # ぷよ消しチェック　戻り値は消えたかどうか
             if is_erase:                    # 消えたら
                 self.rensa += 1             # 連鎖を+1する
             else:                           # 消えなかったら
                 self.is_generate = True     # 次のぷよを発生させる
+        return moved
 
+    # 各列を1回で詰める（空白を上に集め、ぷよの並び順はそのまま）
+    def compact(self):
+        order = np.argsort(self.matrix != 0, axis=0, kind="stable")
+        self.matrix = np.take_along_axis(self.matrix, order, axis=0)
+        return (order != np.arange(H)[:, None]) & (self.matrix != 0)
 
-    def erase(self):
-        checked = [[False] * W for _ in range(H)]
-        directions = [(-1,0), (1,0), (0,-1), (0,1)]
-        found_groups = []
+    # 下に空白があるぷよを1行だけ落とす（表示用のアニメーション）
+    def fall_one_row(self):
+        filled = self.matrix != 0
+        empty_below = np.logical_or.accumulate(~filled[::-1], axis=0)[::-1]    # その行を含めて下に空白があるか
+        falling = np.zeros_like(filled)
+        falling[:-1] = filled[:-1] & empty_below[1:]
+        moved = np.zeros_like(filled)
+        moved[1:] = falling[:-1]
 
-        def bfs(r, c, value):
-            queue = deque()
-            group = []
-            queue.append((r, c))
-            checked[r][c] = True
-            group.append((r, c))
-
-            while queue:
-                x, y = queue.popleft()
-                for dx, dy in directions:
-                    nx, ny = x + dx, y + dy
-                    if (
-                        0 <= nx < H and 0 <= ny < W and
-                        not checked[nx][ny] and self.matrix[nx][ny] == value
-                    ):
-                        checked[nx][ny] = True
-                        queue.append((nx, ny))
-                        group.append((nx, ny))
-
-            return group
-
-        is_erase = False
-        for r in range(H):
-            for c in range(W):
-                if self.matrix[r][c] != 0 and not checked[r][c]:
-                    group = bfs(r, c, self.matrix[r][c])
-                    if len(group) >= OWANIMO:
-                        found_groups.append(group)
-                        is_erase = True
+        fallen = self.matrix.copy()
+        fallen[falling] = 0
+        fallen[moved] = self.matrix[falling]
+        self.matrix = fallen
+        return moved
+
+    # 画面を出さずに連鎖を最後まで進め、(連鎖数, 消えたぷよの数) を返す
+    def resolve(self):
+        rensa = 0
+        cleared = 0
+        self.matrix[self.matrix == ERASED] = 0
+        self.compact()
+        moved = None        # 最初は全体を調べ、2回目からは落ちてきたぷよの周りだけ調べる
+        while True:
+            groups = self.find_groups(moved)
+            if not groups:
+                return rensa, cleared
+            for group in groups:
+                self.matrix[group] = 0
+                cleared += len(group[0])
+            rensa += 1
+            moved = self.compact()
+
+
+    # 同じ色で上下左右にOWANIMO個以上つながっているグループを (行の配列, 列の配列) のリストで返す
+    # touchedを渡すと、そのセルを含むグループだけを調べる（それ以外は前回のチェックから変わっていない）
+    def find_groups(self, touched=None):
+        found_groups = []
+        for color in range(1, COLORS+1):
+            mask = self.matrix == color
+            if touched is not None and not (mask & touched).any():
+                continue
+            n, labels, stats, _ = cv2.connectedComponentsWithStats(mask.view(np.uint8), connectivity=4)
+            large = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] >= OWANIMO)
+            large = large[large != 0]       # 0は背景
+            if touched is not None:
+                large = np.intersect1d(large, labels[mask & touched])
+            for label in large:
+                found_groups.append(np.nonzero(labels == label))
+        return found_groups
 
+    def erase(self):
+        found_groups = self.find_groups(self.changed if self.incremental else None)
+        self.changed[:] = False
         for group in found_groups:
-            for r,c in group:
-                self.matrix[r][c] = "*"   # ぷよが消える演出
+            self.matrix[group] = ERASED   # ぷよが消える演出
 
-        return is_erase
+        return len(found_groups) > 0
 
     def erase_one_color(self):
         color = random.randint(1, COLORS)
-        self.matrix = [[0 if x == color else x for x in row] for row in self.matrix]
+        self.matrix[self.matrix == color] = 0
+
+    # 今の盤面に候補 (列, 色) を置いたときの連鎖数と消えたぷよの数を返す
+    def search(self, candidates, workers=0):
+        return search_drops(self.matrix, candidates, workers)
 
     def gameover(self):
         self.clear()
 
-field = Field()
+# ビットボード
+# ビット番号は c*H + r（列ごとにH個、上の行から）　色ごとに1つの整数で盤面全体を表す
+FULL = (1 << (W*H)) - 1
+COLUMN = (1 << H) - 1
+TOP_ROW = sum(1 << (c*H) for c in range(W))             # 最上段
+BOTTOM_ROW = TOP_ROW << (H-1)                           # 最下段
+NOT_TOP = FULL & ~TOP_ROW
+NOT_BOTTOM = FULL & ~BOTTOM_ROW
+
+def neighbors(bits):
+    # 上下左右に1セル広げる（列をまたがないようにマスクする）
+    return (((bits << 1) & NOT_TOP) | ((bits >> 1) & NOT_BOTTOM) | (bits << H) | (bits >> H)) & FULL
+
+class BitField(Field):
+    """
+    Fieldと同じ使い方ができるビットボード版
+    落下・ぷよ消し・一色消し・最上段のチェックをすべてビット演算で行う
+    drop()が返す動いたセルと、find_groups()が返すグループはビットマスク（整数）
+    """
+    def clear(self):
+        self.bits = [0] * (COLORS+1)    # 色ごとのビットボード（0番は使わない）
+        self.erased = 0                 # ぷよが消える演出のセル
+        self.changed = FULL             # 前回のぷよ消しチェックから置かれた・動いたセル
+
+    # 表示や互換用の配列（ビットボードから作る）
+    @property
+    def matrix(self):
+        matrix = np.zeros((H, W), dtype=np.int8)
+        for color, bits in enumerate(self.bits):
+            if color:
+                matrix[self.to_array(bits)] = color
+        matrix[self.to_array(self.erased)] = ERASED
+        return matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self.bits = [0] + [self.to_bits(matrix == color) for color in range(1, COLORS+1)]
+        self.erased = self.to_bits(matrix == ERASED)
+
+    @staticmethod
+    def to_array(bits):
+        flat = np.unpackbits(np.frombuffer(bits.to_bytes((W*H+7)//8, "little"), np.uint8), bitorder="little")
+        return flat[:W*H].reshape(W, H).T.astype(bool)
+
+    @staticmethod
+    def to_bits(mask):
+        return int.from_bytes(np.packbits(mask.T.ravel(), bitorder="little").tobytes(), "little")
+
+    def occupied(self):
+        occ = 0
+        for bits in self.bits:
+            occ |= bits
+        return occ
+
+    def generate_drop(self):
+        # 全部埋まったとき＝最上段に空きが一つもないときは一色が消える
+        occ = self.occupied()
+        if occ & TOP_ROW == TOP_ROW:
+            self.erase_one_color()
+        else:
+            color = random.randint(1, COLORS)
+            while True:
+                c = random.randint(0, W-1)
+                bit = 1 << (c*H)
+                if not occ & bit:
+                    self.bits[color] |= bit
+                    self.changed |= bit
+                    break
+        self.is_generate = False
+        self.rensa = 0
+
+    def drop(self):
+        erased = self.erased
+        self.erased = 0                     # ぷよが消える演出を空白に戻す
+        moved = self.fall_one_row() if self.animate else self.compact()
+        self.changed |= moved
+
+        if not erased and not moved:        # これ以上動かないならば
+            if self.erase():
+                self.rensa += 1
+            else:
+                self.is_generate = True
+        return moved
 
-while True:
-    if field.is_generate:
-        field.is_generate = False
-        field.generate_drop()
+    # 下に空白があるぷよを1行だけ落とす
+    def fall_one_row(self):
+        empty = FULL & ~self.occupied()
+        below = (empty >> 1) & NOT_BOTTOM   # すぐ下が空白
+        for _ in range(H-2):                # 下のどこかに空白がある
+            below |= (below >> 1) & NOT_BOTTOM
+        moved = 0
+        for color in range(1, COLORS+1):
+            falling = self.bits[color] & below
+            if falling:
+                self.bits[color] = (self.bits[color] & ~falling) | (falling << 1)
+                moved |= falling << 1
+        return moved
+
+    # 動かなくなるまで落とす
+    def compact(self):
+        moved = 0
+        while True:
+            fallen = self.fall_one_row()
+            if not fallen:
+                return moved
+            moved = (moved | fallen) & self.occupied()
+
+    def find_groups(self, touched=None):
+        found_groups = []
+        for color in range(1, COLORS+1):
+            rest = self.bits[color]
+            seeds = rest if touched is None else rest & touched
+            while seeds:
+                group = seeds & -seeds      # 一番下のビットから塗りつぶす
+                while True:
+                    grown = (group | neighbors(group)) & rest
+                    if grown == group:
+                        break
+                    group = grown
+                rest &= ~group
+                seeds &= ~group
+                if group.bit_count() >= OWANIMO:
+                    found_groups.append(group)
+        return found_groups
+
+    def erase(self):
+        found_groups = self.find_groups(self.changed if self.incremental else None)
+        self.changed = 0
+        for group in found_groups:
+            for color in range(1, COLORS+1):
+                self.bits[color] &= ~group
+            self.erased |= group            # ぷよが消える演出
+
+        return len(found_groups) > 0
+
+    def erase_one_color(self):
+        color = random.randint(1, COLORS)
+        self.bits[color] = 0
+
+    def resolve(self):
+        rensa = 0
+        cleared = 0
+        self.erased = 0
+        self.compact()
+        moved = None
+        while True:
+            groups = self.find_groups(moved)
+            if not groups:
+                return rensa, cleared
+            for group in groups:
+                for color in range(1, COLORS+1):
+                    self.bits[color] &= ~group
+                cleared += group.bit_count()
+            rensa += 1
+            moved = self.compact()
+
+# 複数の盤面をまとめて進める
+# 盤面は (N, H, W) の配列で、候補ごとに1枚ずつ重ねて同時に落下・ぷよ消しをする
+
+# 各盤面の各列を1回で詰める
+def compact_boards(boards):
+    order = np.argsort(boards != 0, axis=1, kind="stable")
+    return np.take_along_axis(boards, order, axis=1)
+
+# 盤面の束の連鎖を最後まで進め、盤面ごとの (連鎖数, 消えたぷよの数) を配列で返す
+def resolve_boards(boards):
+    boards = compact_boards(np.where(boards == ERASED, 0, boards).astype(np.int8))
+    n = len(boards)
+    rensa = np.zeros(n, dtype=int)
+    cleared = np.zeros(n, dtype=int)
+    alive = np.arange(n)                # まだ連鎖が続いているかもしれない盤面
+    while len(alive):
+        # 盤面を空白の行をはさんで縦に並べ、1枚の画像として色ごとにラベリングする
+        mosaic = np.zeros((len(alive), H+1, W), dtype=np.int8)
+        mosaic[:, :H] = boards[alive]
+        mosaic = mosaic.reshape(-1, W)
+        erased = np.zeros(mosaic.shape, dtype=bool)
+        for color in range(1, COLORS+1):
+            mask = mosaic == color
+            if not mask.any():
+                continue
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(mask.view(np.uint8), connectivity=4)
+            large = stats[:, cv2.CC_STAT_AREA] >= OWANIMO
+            large[0] = False            # 0は背景
+            erased |= large[labels]
+        erased = erased.reshape(len(alive), H+1, W)[:, :H]
+
+        counts = erased.sum(axis=(1, 2))
+        hit = counts > 0
+        alive = alive[hit]
+        erased = erased[hit]
+        rensa[alive] += 1
+        cleared[alive] += counts[hit]
+        boards[alive] = compact_boards(np.where(erased, 0, boards[alive]))
+    return rensa, cleared
+
+# 盤面matrixに候補 (列, 色) をそれぞれ落としたときの連鎖数と消えたぷよの数を返す
+# 置けない候補（列が最上段まで埋まっている）は連鎖数を-1にする
+# workersを指定すると、候補をchunkずつに分けて複数プロセスで計算する
+def search_drops(matrix, candidates, workers=0, chunk=4096):
+    candidates = np.asarray(candidates, dtype=int).reshape(-1, 2)
+    cols, colors = candidates[:, 0], candidates[:, 1]
+    base = compact_boards(np.where(matrix == ERASED, 0, matrix).astype(np.int8)[None])[0]
+    valid = base[0, cols] == 0
+
+    boards = np.repeat(base[None], len(candidates), axis=0)
+    boards[np.arange(len(candidates)), 0, cols] = np.where(valid, colors, 0)
+
+    if workers and len(boards) > chunk:
+        from multiprocessing import Pool
+        with Pool(workers) as pool:
+            results = pool.map(resolve_boards, [boards[i:i+chunk] for i in range(0, len(boards), chunk)])
+        rensa = np.concatenate([r for r, _ in results])
+        cleared = np.concatenate([c for _, c in results])
+    else:
+        rensa, cleared = resolve_boards(boards)
+    rensa[~valid] = -1
+    cleared[~valid] = 0
+    return rensa, cleared
+
+# 1セル分の表示
+def cell_text(cell):
+    if cell == 0:
+        return " "
+    elif cell == ERASED:
+        return "\033[3*m*\033[0m"
     else:
-        field.drop()
-    field.print()
+        return f"\033[3{cell}m{cell}\033[0m"
+
+def rensa_text(rensa):
+    return " "*20 if rensa==0 else f"   {rensa}連鎖{'!'*(rensa)}".ljust(20)
+
+# ターミナル表示
+# ゲームのループとは別のスレッドで一定間隔ごとに盤面を見て、前回表示したときから変わったセルだけを書き換える
+# 描画中に盤面が書き換わって途中の状態が見えても、次の描画で直る
+class Screen():
+    def __init__(self, field, fps=30):
+        self.field = field
+        self.interval = 1 / fps
+        self.shown = None           # 前回表示した盤面
+        self.shown_rensa = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        sys.stdout.write("\033[?25l")     # カーソルを消す
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.draw()
+        sys.stdout.write(f"\033[{H+3};1H\033[?25h")   # 盤面の下にカーソルを戻す
+        sys.stdout.flush()
+
+    def loop(self):
+        next_tick = perf_counter()
+        while self.running:
+            self.draw()
+            next_tick = max(next_tick + self.interval, perf_counter())
+            sleep(next_tick - perf_counter())
+
+    def draw(self):
+        matrix = self.field.matrix.copy()
+        rensa = self.field.rensa
+        if self.shown is None:
+            # 最初は画面を消して全体を描く
+            texts = "\033[2J\033[H" + rensa_text(rensa) + "\n"
+            for r, row in enumerate(matrix):
+                texts += f"{r:02} " + "".join(cell_text(cell) for cell in row) + "\n"
+            texts += "   " + "=" * W
+        else:
+            # 変わったセルだけカーソルを移動して書く（行・列は1から）
+            texts = ""
+            if rensa != self.shown_rensa:
+                texts += "\033[1;1H" + rensa_text(rensa)
+            for r, c in zip(*np.nonzero(matrix != self.shown)):
+                texts += f"\033[{r+2};{c+4}H" + cell_text(matrix[r, c])
+        self.shown = matrix
+        self.shown_rensa = rensa
+        if texts:
+            sys.stdout.write(texts)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fps", type=float, default=30, help="表示の更新回数（1秒あたり）")
+    parser.add_argument("--no-display", action="store_true", help="表示せずにゲームだけ進める")
+    parser.add_argument("--wait", type=float, default=0.001, help="ゲームの1ステップごとの待ち時間")
+    parser.add_argument("--erase-wait", type=float, default=0.8, help="ぷよが消えるときの待ち時間")
+    args = parser.parse_args()
+
+    field = Field(animate=not args.no_display)
+    screen = None
+    if not args.no_display:
+        screen = Screen(field, args.fps)
+        screen.start()
+
+    try:
+        while True:
+            if field.is_generate:
+                field.is_generate = False
+                field.generate_drop()
+            else:
+                field.drop()
+            if screen is not None:
+                is_owanimo = (field.matrix == ERASED).any()     # * があるかどうか
+                sleep(args.erase_wait if is_owanimo else args.wait)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if screen is not None:
+            screen.stop()
@@ -0,0 +1,120 @@
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+
+# シミュレーションの画面を別スレッドで動画ファイルに書き出す
+# write()はフレームをコピーしてキューに入れるだけなので、表示のループを待たせない
+# キューがいっぱいのとき、policy="drop"ならそのフレームを捨て、"block"なら空くまで待つ
+# raw=Trueなら、画像の代わりにパレット番号の配列をnp.saveで書き続ける（あとでto_videoで動画にする）
+class Recorder():
+    def __init__(self, filename, fps=30, policy="drop", maxsize=64, fourcc="mp4v", raw=False):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"policy must be 'drop' or 'block': {policy}")
+        self.filename = filename
+        self.fps = fps
+        self.policy = policy
+        self.fourcc = fourcc
+        self.raw = raw
+        self.queue = queue.Queue(maxsize)
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    # 1フレーム渡す　キューに入れられたかどうかを返す
+    def write(self, frame):
+        frame = np.array(frame, copy=True)     # 呼び出し側は同じバッファに次のフレームを描くのでコピーする
+        if self.policy == "block":
+            self.queue.put(frame)
+            return True
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def loop(self):
+        writer = None
+        f = None
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                if self.raw:
+                    if f is None:
+                        f = open(self.filename, "wb")
+                    np.save(f, frame)
+                else:
+                    if writer is None:
+                        height, width = frame.shape[:2]
+                        writer = cv2.VideoWriter(self.filename, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+                        if not writer.isOpened():
+                            raise IOError(f"cannot open video writer: {self.filename}")
+                    writer.write(frame)
+                self.written += 1
+        except Exception as e:
+            self.error = e
+            # 書けなくなっても呼び出し側を止めないよう、残りは読み捨てる
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.release()
+            if f is not None:
+                f.close()
+
+    # 残りのフレームを書き終えてから閉じる
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# raw=Trueで書いたパレット番号の列を動画にする
+# paletteは番号ごとのBGR、scaleは1セルのピクセル数
+def to_video(raw_filename, video_filename, palette, fps=30, scale=1, fourcc="mp4v"):
+    palette = np.asarray(palette, np.uint8)
+    writer = None
+    frames = 0
+    with open(raw_filename, "rb") as f:
+        while True:
+            try:
+                index = np.load(f)
+            except (EOFError, ValueError):
+                break
+            image = palette[index]
+            if scale != 1:
+                image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+            if writer is None:
+                height, width = image.shape[:2]
+                writer = cv2.VideoWriter(video_filename, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+            writer.write(image)
+            frames += 1
+    if writer is not None:
+        writer.release()
+    return frames
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Recorder(raw=True)で書いたパレット番号の列を動画にする")
+    parser.add_argument("raw")
+    parser.add_argument("video")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--scale", type=int, default=1)
+    args = parser.parse_args()
+    import sand
+    print(to_video(args.raw, args.video, sand.COLORS, args.fps, args.scale), "frames")
@@ -2,6 +2,7 @@ import numpy as np
 import cv2
 import math
 import random
+from collections import OrderedDict
 
 BLACK = (0, 0, 0)
 GRAY = (128, 128, 128)
@@ -18,49 +19,94 @@ WHITE = (255, 255, 255)
 
 COLORS = [BLACK, RED, GREEN, BLUE, CYAN, MAGENTA, YELLOW, ORANGE, PINK, GRAY, WHITE]
 
+# 移動列の1周期のステップ数
+MOVE_PERIOD = 64
+
+# 8近傍 (dr, dc)
+NEIGHBOURS = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+
 
 # 重力方向を360度の角度で指定（真下が0度）
 def gravity_vector(angle):
     rad = math.radians(angle)
     return (math.sin(rad), math.cos(rad))
 
+# 重力方向への1周期分の移動列 (dx, dy) を整数で作る
+# k歩目までの移動回数をfloor(k*m/period)とするので、累積誤差補正法と同じ間隔で動く
+def move_sequence(angle, period=MOVE_PERIOD):
+    k = np.arange(1, period+1)
+    table = np.zeros((period, 2), dtype=np.int8)
+    for i, g in enumerate(gravity_vector(angle)):
+        m = round(abs(g) * period)
+        table[:, i] = np.sign(g) * (k * m // period - (k-1) * m // period)
+    return table
+
 class App():
-    def __init__(self):
+    def __init__(self, division=32, grains=10, vectorized=True, track_active=True, compact=False, use_table=False):
+        self.vectorized = vectorized        # Trueなら配列演算でまとめて処理する
+        self.track_active = track_active    # Trueなら動ける砂粒だけを処理する（vectorized時のみ）
+        self.use_table = use_table          # Trueなら累積誤差の代わりに移動列と位相で動かす
         self.width = 800
         self.height = 640
         self.image = np.full((self.height, self.width, 3), WHITE, np.uint8)
 
         # グリッド
-        self.division = 32
-        self.grid = np.zeros((self.division, self.division), dtype=int)
-        self.errors =  np.zeros((self.division, self.division, 2), dtype=float)     # 累積誤差を管理する変数
+        self.division = division
+        # compactならセルIDをuint8、累積誤差をfloat32で持つ（1セル24バイト→9バイト）
+        grid_dtype, error_dtype = (np.uint8, np.float32) if compact else (int, float)
+        self.grid = np.zeros((self.division, self.division), dtype=grid_dtype)
+        self.back_grid = np.zeros_like(self.grid)       # 1ステップ前のグリッドと入れ替えて使う
+        if self.use_table:
+            self.errors = None
+            self.phases = np.zeros((self.division, self.division), dtype=np.uint8)      # 移動列の位相
+            self.table_angle = None
+        else:
+            self.errors =  np.zeros((self.division, self.division, 2), dtype=error_dtype)     # 累積誤差を管理する変数
+            self.phases = None
 
-        # 円の外を壁にする
-        columns = [range(5), range(3), range(2), [0], [0]]
-        for r, cols in enumerate(columns):
-            for c in cols:
-                self.set_symmetric(r, c, 9)
+        # 円の外を壁にする（中心からの距離が0.6*divisionを超えるセル。32分割なら各隅5,3,2,1,1個）
+        offsets = (np.arange(self.division, dtype=np.float32) + 0.5 - self.division/2) ** 2
+        self.grid[offsets[:, None] + offsets[None, :] > (0.6 * self.division) ** 2] = 9
 
         # ランダムに砂を発生させる
         color_id = 2
-        for _ in range(10):
+        for _ in range(grains):
             c = random.randint(0, self.division-1)
             r = random.randint(0, self.division-1)
             if self.grid[r, c] == 0:
                 self.grid[r, c] = color_id
                 color_id = (color_id % 8) + 1   # 2~8でループ
-
+        self.wake_all()
 
         # ディスク
         self.disc_size = min(self.height, self.width)
-        self.tile_size = self.disc_size // self.division
+        self.tile_size = max(1, self.disc_size // self.division)
+        self.grid_px = min(self.tile_size * self.division, self.disc_size)   # グリッドを描く範囲
         disc = np.full((self.disc_size, self.disc_size, 3), BLACK, np.uint8)
         cv2.circle(disc, (self.disc_size//2, self.disc_size//2), self.disc_size//2, WHITE, 1)
-        for x in range(0, self.disc_size, self.tile_size):
-            cv2.line(disc, (x,0), (x,self.disc_size), GREEN, 1)
-        for y in range(0, self.disc_size, self.tile_size):
-            cv2.line(disc, (0,y), (self.disc_size,y), GREEN, 1)
+        if self.tile_size >= 3:     # セルが小さすぎるときは格子線を描かない
+            for x in range(0, self.disc_size, self.tile_size):
+                cv2.line(disc, (x,0), (x,self.disc_size), GREEN, 1)
+            for y in range(0, self.disc_size, self.tile_size):
+                cv2.line(disc, (0,y), (self.disc_size,y), GREEN, 1)
         self.disc_origin = disc
+
+        # 描画用のカラーパレットと、セルの上に重ねる円・格子線の画素
+        self.palette = np.array(COLORS, np.uint8)
+        self.overlay_index = np.flatnonzero(disc.any(axis=2))
+        self.overlay_pixels = disc.reshape(-1, 3)[self.overlay_index]
+        self.disc = np.zeros_like(disc)
+        # グリッドが描画範囲より大きいときは、拡大縮小の前に間引いておく
+        self.sample_index = np.arange(self.grid_px) * self.division // self.grid_px if self.division > self.grid_px else None
+
+        # 回転表示：角度ごとの回転マップをLRUでキャッシュする
+        self.rotate_lowres = False      # Trueなら低解像度のグリッドだけを回転してから拡大する
+        self.rotation_cache = OrderedDict()
+        self.rotation_cache_size = 8
+        circle = np.zeros_like(disc)
+        cv2.circle(circle, (self.disc_size//2, self.disc_size//2), self.disc_size//2, WHITE, 1)
+        self.circle_index = np.flatnonzero(circle.any(axis=2))
+        self.disc_rot = np.zeros_like(disc)
         self.angle = 0
 
     def set_symmetric(self, r, c, value):
@@ -100,67 +146,301 @@ class App():
         # 移動が無効な場合はその場にとどまる
         return r, c
 
+    # 移動列から次の移動先を決める　位相は動けたかどうかに関係なく進む
+    def find_closest_cell_with_table(self, r, c):
+        table = self.current_table()
+        move_x, move_y = map(int, table[self.phases[r, c]])     # int8のままだと座標の足し算があふれる
+        phase = (self.phases[r, c] + 1) % len(table)
+
+        nr, nc = r + move_y, c + move_x
+        if 0 <= nr < self.division and 0 <= nc < self.division and self.grid[nr, nc] == 0:
+            self.phases[nr, nc] = phase
+            self.phases[r, c] = 0
+            return nr, nc
+
+        self.phases[r, c] = phase
+        return r, c
+
+    # 現在の角度の移動列（角度が変わったときだけ作り直す）
+    def current_table(self):
+        if self.table_angle != self.angle:
+            self.move_table = move_sequence(self.angle)
+            self.table_angle = self.angle
+        return self.move_table
+
+    # 移動の状態を持つ配列（累積誤差または位相）
+    def move_states(self):
+        return self.phases if self.use_table else self.errors
+
+    # 各砂粒の移動量(dr, dc)と、移動した場合・とどまった場合に持ち越す状態を返す
+    def next_moves(self, rs, cs):
+        if self.use_table:
+            table = self.current_table()
+            phases = self.phases[rs, cs]
+            moves = table[phases]
+            phases = (phases + 1) % len(table)
+            return moves[:, 1], moves[:, 0], phases, phases
+
+        errors = self.errors[rs, cs] + np.array(self.gravity, self.errors.dtype)
+        # 誤差が1以上になった成分だけ移動し、その分を補正する
+        moves = np.where(np.abs(errors) >= 1, np.sign(errors), 0)
+        return moves[:, 1].astype(int), moves[:, 0].astype(int), errors - moves, errors
+
+    # 待っても移動先が空かない砂粒かどうか
+    def can_sleep(self, rs, cs, states):
+        if self.use_table:
+            # 移動列に含まれるどの移動先もふさがっていれば、位相が進んでも動けない
+            blocked = np.ones(len(rs), dtype=bool)
+            for dc, dr in np.unique(self.current_table(), axis=0):
+                if dr == 0 and dc == 0:
+                    continue
+                nr, nc = rs + dr, cs + dc
+                free = (0 <= nr) & (nr < self.division) & (0 <= nc) & (nc < self.division)
+                free[free] = self.grid[nr[free], nc[free]] == 0
+                blocked &= ~free
+            return blocked
+        # 誤差がすでに1以上か重力成分がない方向は、待っても移動先が変わらない
+        return np.all((np.abs(states) >= 1) | (np.abs(self.gravity) < 1e-9), axis=1)
+
     def reset_errors(self):
-        self.errors =  np.zeros((self.division, self.division, 2), dtype=float)
+        self.move_states().fill(0)
+        self.wake_all()     # 角度が変わると移動先も変わるので全部起こす
+
+    # すべての砂粒を処理対象にする（グリッドを直接書き換えたときにも呼ぶ）
+    def wake_all(self):
+        self.active = np.flatnonzero((0 < self.grid) & (self.grid < 9))
 
+    # 1ステップ進めて、動いた砂粒の数を返す
     def simulate_sand(self):
+        if self.vectorized and self.track_active:
+            return self.simulate_sand_active()
+        elif self.vectorized:
+            return self.simulate_sand_vectorized()
+        else:
+            return self.simulate_sand_loop()
+
+    # これ以上動く砂粒がないかどうか
+    # active追跡なしの場合は、直前のステップで1粒も動かず、すべての砂粒が待っても動けないことで判定する
+    # （誤差がたまる途中の砂粒は、そのステップで動かなくても止まったとはいえない）
+    def is_settled(self, moved):
+        if self.vectorized and self.track_active:
+            return len(self.active) == 0
+        return moved == 0 and self.all_blocked()
+
+    # すべての砂粒がcan_sleepの条件を満たすかどうか
+    def all_blocked(self):
+        self.gravity = gravity_vector(self.angle)
+        rs, cs = np.nonzero((0 < self.grid) & (self.grid < 9))
+        return bool(self.can_sleep(rs, cs, self.move_states()[rs, cs]).all())
+
+    # 1セルずつ処理する元の実装（検証用）
+    def simulate_sand_loop(self):
         self.gravity = gravity_vector(self.angle)
 
-        updated = False
-        new_grid = self.grid.copy()
+        find_closest_cell = self.find_closest_cell_with_table if self.use_table else self.find_closest_cell_with_error
+        moved = 0
+        new_grid = self.back_grid
+        np.copyto(new_grid, self.grid)
 
         for r in range(self.division):
             for c in range(self.division):
                 if 0 < self.grid[r, c] < 9:  # IDを持つ砂粒のみ移動
                     sand_id = self.grid[r, c]  # 現在の砂粒のID
-                    next_cell = self.find_closest_cell_with_error(r, c)
+                    next_cell = find_closest_cell(r, c)
                     if next_cell:
                         nr, nc = next_cell
                         if (nr, nc) != (r, c):  # 移動先が現在の位置でない場合
                             new_grid[nr, nc] = sand_id
                             new_grid[r, c] = 0
-                            updated = True
+                            moved += 1
 
-        self.grid = new_grid
+        self.grid, self.back_grid = new_grid, self.grid
+        return moved
 
-    def show(self):
-        disc = self.disc_origin.copy()
-        for r in range(self.division):
-            for c in range(self.division):
-                x0 = c * self.tile_size
-                y0 = r * self.tile_size
-                x1 = (c+1) * self.tile_size
-                y1 = (r+1) * self.tile_size
-                cell = self.grid[r,c]
-                color = COLORS[cell]
-                if color:
-                    cv2.rectangle(disc, (x0,y0), (x1,y1), color, -1)
-
-        # 基準の真下
-        x0, y0 = self.disc_size//2, self.disc_size//2
-        x1, y1 = x0, self.disc_size
-        cv2.line(disc, (x0, y0), (x1, y1), RED, 1)
+    # 全砂粒を配列演算でまとめて1ステップ進める（simulate_sand_loopと同じ結果になる）
+    def simulate_sand_vectorized(self):
+        self.gravity = gravity_vector(self.angle)
+
+        # 砂粒の位置（ラスタ順）と移動の状態の更新
+        rs, cs = np.nonzero((0 < self.grid) & (self.grid < 9))
+        states = self.move_states()
+        dr, dc, carried, stayed = self.next_moves(rs, cs)
+        states[rs, cs] = stayed
+        nr, nc = rs + dr, cs + dc
+
+        # 移動先が範囲内で、かつ移動前のグリッドで空いていれば移動できる
+        movable = (0 <= nr) & (nr < self.division) & (0 <= nc) & (nc < self.division)
+        movable[movable] = self.grid[nr[movable], nc[movable]] == 0
+        rs, cs, nr, nc, carried = rs[movable], cs[movable], nr[movable], nc[movable], carried[movable]
+
+        # 同じセルに複数の砂粒が向かう場合はラスタ順で最後の砂粒が残る（ループ版と同じ）
+        targets = nr * self.division + nc
+        _, last = np.unique(targets[::-1], return_index=True)
+        winners = len(targets) - 1 - last
+
+        new_grid = self.back_grid
+        np.copyto(new_grid, self.grid)
+        new_grid[rs, cs] = 0
+        new_grid[nr[winners], nc[winners]] = self.grid[rs[winners], cs[winners]]
+        states[rs, cs] = 0
+        states[nr[winners], nc[winners]] = carried[winners]
+
+        self.grid, self.back_grid = new_grid, self.grid
+        return len(rs)
+
+    # 起きている砂粒だけを1ステップ進める
+    # 動けず、移動先がこれ以上変わらない砂粒は眠らせ、隣のセルが空いたときだけ起こす
+    # 眠っている間は誤差の蓄積（位相）が止まるので、それ以外はsimulate_sand_vectorizedと同じ結果になる
+    def simulate_sand_active(self):
+        self.gravity = gravity_vector(self.angle)
+
+        rs, cs = np.divmod(self.active, self.division)
+        states = self.move_states()
+        dr, dc, carried, stayed = self.next_moves(rs, cs)
+        states[rs, cs] = stayed
+        nr, nc = rs + dr, cs + dc
+
+        movable = (0 <= nr) & (nr < self.division) & (0 <= nc) & (nc < self.division)
+        movable[movable] = self.grid[nr[movable], nc[movable]] == 0
+
+        waiting = ~movable
+        waiting[waiting] = ~self.can_sleep(rs[waiting], cs[waiting], stayed[waiting])
+        staying = self.active[waiting]
+        rs, cs, nr, nc, carried = rs[movable], cs[movable], nr[movable], nc[movable], carried[movable]
+
+        targets = nr * self.division + nc
+        _, last = np.unique(targets[::-1], return_index=True)
+        winners = np.zeros(len(targets), dtype=bool)
+        winners[len(targets) - 1 - last] = True
+        # 移動先を取り合って負けた砂粒はその場に残り、次のステップでもう一度動こうとする
+        losers = rs[~winners] * self.division + cs[~winners]
+        rs, cs, nr, nc, targets, carried = rs[winners], cs[winners], nr[winners], nc[winners], targets[winners], carried[winners]
+
+        # 移動前のグリッドで判定済みなので、コピーせずにその場で書き換える
+        sand_ids = self.grid[rs, cs]
+        self.grid[rs, cs] = 0
+        self.grid[nr, nc] = sand_ids
+        states[rs, cs] = 0
+        states[nr, nc] = carried
 
-        # 重力の方向
+        # 空いたセルの8近傍にいる砂粒を起こす
+        nbr_r = (rs[:, None] + NEIGHBOURS[:, 0]).ravel()
+        nbr_c = (cs[:, None] + NEIGHBOURS[:, 1]).ravel()
+        inside = (0 <= nbr_r) & (nbr_r < self.division) & (0 <= nbr_c) & (nbr_c < self.division)
+        nbr_r, nbr_c = nbr_r[inside], nbr_c[inside]
+        cells = self.grid[nbr_r, nbr_c]
+        is_sand = (0 < cells) & (cells < 9)
+        woken = nbr_r[is_sand] * self.division + nbr_c[is_sand]
+
+        candidates = np.concatenate([staying, losers, targets, woken])
+        if len(candidates) * 16 > self.grid.size:   # 候補が多いときは並べ替えるよりマスクの方が速い
+            mark = np.zeros(self.grid.size, dtype=bool)
+            mark[candidates] = True
+            self.active = np.flatnonzero(mark)
+        else:
+            self.active = np.unique(candidates)
+        return len(rs)
+
+    # グリッドをパレットで色に変換し、拡大して円と格子線を重ねる
+    def render_disc(self):
+        cells = cv2.resize(self.palette[self.display_grid()], (self.grid_px, self.grid_px), interpolation=cv2.INTER_NEAREST)
+        self.disc[:self.grid_px, :self.grid_px] = cells
+        self.disc[self.grid_px:] = BLACK
+        self.disc[:, self.grid_px:] = BLACK
+        self.disc.reshape(-1, 3)[self.overlay_index] = self.overlay_pixels
+        return self.disc
+
+    # 描画するグリッド（描画範囲より大きいときは間引く）
+    def display_grid(self):
+        if self.sample_index is None:
+            return self.grid
+        return self.grid[np.ix_(self.sample_index, self.sample_index)]
+
+    # 基準の真下と重力の方向の線を描く　Mを渡すとその回転を適用した位置に描く
+    def draw_gravity(self, img, M=None):
+        x0, y0 = self.disc_size//2, self.disc_size//2
         gx, gy = gravity_vector(self.angle)
-        x1 = int(x0 + self.disc_size * gx)
-        y1 = int(y0 + self.disc_size * gy)
-        cv2.line(disc, (x0, y0), (x1, y1), BLUE, 1)
+        lines = [((x0, y0), (x0, self.disc_size), RED),
+                 ((x0, y0), (int(x0 + self.disc_size * gx), int(y0 + self.disc_size * gy)), BLUE)]
+        for p0, p1, color in lines:
+            if M is not None:
+                p0, p1 = cv2.transform(np.array([[p0, p1]], np.float64), M)[0].astype(int)
+            cv2.line(img, tuple(map(int, p0)), tuple(map(int, p1)), color, 1)
+
+    # 角度ごとのremap用テーブル（固定小数点）を返す
+    def rotation_maps(self, size, angle, center):
+        key = (size, angle % 360, center)
+        if key in self.rotation_cache:
+            self.rotation_cache.move_to_end(key)
+            return self.rotation_cache[key]
+
+        M = cv2.getRotationMatrix2D(center, -angle, 1)
+        iM = cv2.invertAffineTransform(M)
+        xs, ys = np.meshgrid(np.arange(size), np.arange(size))
+        map_x = (iM[0, 0] * xs + iM[0, 1] * ys + iM[0, 2]).astype(np.float32)
+        map_y = (iM[1, 0] * xs + iM[1, 1] * ys + iM[1, 2]).astype(np.float32)
+        maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
 
-        M = cv2.getRotationMatrix2D((self.disc_size//2, self.disc_size//2), -self.angle, 1)
-        disc_rot = cv2.warpAffine(disc, M, (self.disc_size, self.disc_size))
+        self.rotation_cache[key] = maps
+        if len(self.rotation_cache) > self.rotation_cache_size:
+            self.rotation_cache.popitem(last=False)
+        return maps
+
+    # 回転表示用の画像を作る
+    def render_rotated(self, disc):
+        center = (self.disc_size//2, self.disc_size//2)
+        if not self.rotate_lowres:
+            map1, map2 = self.rotation_maps(self.disc_size, self.angle, center)
+            return cv2.remap(disc, map1, map2, cv2.INTER_LINEAR, dst=self.disc_rot)
+
+        # グリッドの解像度で回転してから拡大し、円と線だけを描き直す
+        cells = self.palette[self.display_grid()]
+        size = cells.shape[0]
+        map1, map2 = self.rotation_maps(size, self.angle, ((size-1)/2, (size-1)/2))
+        cells = cv2.remap(cells, map1, map2, cv2.INTER_NEAREST)
+        self.disc_rot[:] = BLACK
+        self.disc_rot[:self.grid_px, :self.grid_px] = cv2.resize(cells, (self.grid_px, self.grid_px), interpolation=cv2.INTER_NEAREST)
+        self.disc_rot.reshape(-1, 3)[self.circle_index] = WHITE
+        self.draw_gravity(self.disc_rot, cv2.getRotationMatrix2D(center, -self.angle, 1))
+        return self.disc_rot
+
+    # 円盤を画面の中央に置いた画像
+    def compose(self, disc):
         x0 = (self.width - self.disc_size)//2
         x1 = (self.width + self.disc_size)//2
         self.image[:, x0:x1] = disc
-        cv2.imshow("origin", self.image)
-        self.image[:, x0:x1] = disc_rot
-        cv2.imshow("rot", self.image)
+        return self.image
+
+    # recorderを渡すと回転後の画面を録画する
+    def show(self, recorder=None):
+        disc = self.render_disc()
+        self.draw_gravity(disc)
+        disc_rot = self.render_rotated(disc)
+        cv2.imshow("origin", self.compose(disc))
+        image = self.compose(disc_rot)
+        if recorder is not None:
+            recorder.write(image)
+        cv2.imshow("rot", image)
+
+    # ウィンドウを出さずに回転後の画面を録画する
+    def record(self, recorder):
+        disc = self.render_disc()
+        self.draw_gravity(disc)
+        recorder.write(self.compose(self.render_rotated(disc)))
 
 def main():
+    import argparse
+    from recorder import Recorder
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", help="画面を録画する動画ファイル")
+    parser.add_argument("--policy", choices=["drop", "block"], default="drop", help="録画が追いつかないときの動作")
+    args = parser.parse_args()
+
     app = App()
+    recorder = Recorder(args.record, fps=10, policy=args.policy) if args.record else None
     while True:
         app.simulate_sand()
-        app.show()
+        app.show(recorder)
         key = cv2.waitKey(100) & 0xFF
         if key == 27:
             break
@@ -170,6 +450,8 @@ def main():
         elif key == ord("d"):
             app.angle -= 10
             app.reset_errors()
+    if recorder is not None:
+        recorder.close()
     cv2.destroyAllWindows()
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@ import cv2
 # 定数定義
 EMPTY = 0  # 空
 SAND_BASE = 1  # 砂粒の識別用ベース値
+MOVE_PERIOD = 64  # 移動列の1周期のステップ数
 
 # グリッドの初期化（砂粒10個を配置する）
 def initialize_grid(rows, cols):
@@ -20,6 +21,16 @@ def gravity_vector(angle):
     rad = math.radians(angle)
     return (math.sin(rad), math.cos(rad))  # 真下が0度に対応
 
+# 重力方向への1周期分の移動列 (dx, dy) を整数で作る
+# k歩目までの移動回数をfloor(k*m/period)とするので、累積誤差補正法と同じ間隔で動く
+def move_sequence(gravity_angle, period=MOVE_PERIOD):
+    k = np.arange(1, period + 1)
+    table = np.zeros((period, 2), dtype=int)
+    for i, g in enumerate(gravity_vector(gravity_angle)):
+        m = round(abs(g) * period)
+        table[:, i] = np.sign(g) * (k * m // period - (k - 1) * m // period)
+    return table
+
 # 累積誤差補正法を使用した最も重力方向に近い隣接セルを計算
 def find_closest_cell_with_error(r, c, gravity, rows, cols, grid, error):
     dx, dy = gravity  # 重力ベクトルの成分
@@ -46,6 +57,19 @@ def find_closest_cell_with_error(r, c, gravity, rows, cols, grid, error):
     # 移動が無効な場合はその場にとどまる
     return r, c
 
+# 移動列を使用して隣接セルを計算（浮動小数点の誤差を使わない）
+def find_closest_cell_with_table(r, c, table, rows, cols, grid, phase):
+    move_x, move_y = table[phase[0]]
+    phase[0] = (phase[0] + 1) % len(table)  # 位相を進める
+
+    # 移動先セルの決定
+    nr, nc = r + move_y, c + move_x
+    if 0 <= nr < rows and 0 <= nc < cols and grid[nr, nc] == EMPTY:
+        return nr, nc
+
+    # 移動が無効な場合はその場にとどまる
+    return r, c
+
 # 重力角度をキー入力に基づいて変更
 def update_gravity(gravity_angle, key):
     # 真下を0度とする角度マッピング
@@ -80,10 +104,14 @@ def draw_grid(grid, cell_size=20):
     return img
 
 # 砂粒のシミュレーション
-def simulate_sand(grid, gravity_angle):
+# recorderを渡すと描画した画像を録画する
+def simulate_sand(grid, gravity_angle, use_table=False, recorder=None):
     rows, cols = grid.shape
     gravity = gravity_vector(gravity_angle)  # 重力ベクトルを計算
     error = [0, 0]  # 累積誤差を管理する変数
+    table = move_sequence(gravity_angle)  # use_table時の移動列
+    phase = [0]  # 移動列の位相
+    table_angle = gravity_angle
 
     while True:
         updated = False
@@ -93,7 +121,10 @@ def simulate_sand(grid, gravity_angle):
             for c in range(cols):
                 if grid[r, c] > EMPTY:  # IDを持つ砂粒のみ移動
                     sand_id = grid[r, c]  # 現在の砂粒のID
-                    next_cell = find_closest_cell_with_error(r, c, gravity, rows, cols, new_grid, error)
+                    if use_table:
+                        next_cell = find_closest_cell_with_table(r, c, table, rows, cols, new_grid, phase)
+                    else:
+                        next_cell = find_closest_cell_with_error(r, c, gravity, rows, cols, new_grid, error)
                     if next_cell:
                         nr, nc = next_cell
                         if (nr, nc) != (r, c):  # 移動先が現在の位置でない場合
@@ -105,6 +136,8 @@ def simulate_sand(grid, gravity_angle):
 
         # グリッドを描画して表示
         img = draw_grid(grid)
+        if recorder is not None:
+            recorder.write(img)
         cv2.imshow("Sand Simulation", img)
 
         # キー入力の取得（終了キー: 'sec'）
@@ -119,6 +152,10 @@ def simulate_sand(grid, gravity_angle):
             gravity_angle = update_gravity(gravity_angle, key_char)
             gravity = gravity_vector(gravity_angle)  # 重力ベクトルを更新
             error = [0, 0]  # 累積誤差をリセット
+            if table_angle != gravity_angle:  # 角度が変わったときだけ移動列を作り直す
+                table = move_sequence(gravity_angle)
+                table_angle = gravity_angle
+            phase = [0]  # 位相をリセット
 
 #        if not updated:
 #            break
@@ -134,4 +171,10 @@ if __name__ == "__main__":
     print("シミュレーション開始:")
     print("キー操作:\n x:下, z:左下, a:左, q:左上, w:上, e:右上, d:右, c:右下")
     print("終了するには 'sec' を押してください。")
-    simulate_sand(grid, gravity_angle)
\ No newline at end of file
+    import sys
+    if len(sys.argv) > 1:  # 引数に動画ファイル名を指定すると録画する
+        from recorder import Recorder
+        with Recorder(sys.argv[1]) as recorder:
+            simulate_sand(grid, gravity_angle, recorder=recorder)
+    else:
+        simulate_sand(grid, gravity_angle)
\ No newline at end of file
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+import sand
+from recorder import Recorder
+from sand_parallel import ParallelSand
+
+
+# 角度スケジュールの文字列 "0:0,200:30" を {ステップ: 角度} に変換
+def parse_schedule(text):
+    schedule = {}
+    if text:
+        for item in text.split(","):
+            step, angle = item.split(":")
+            schedule[int(step)] = int(angle)
+    return schedule
+
+
+# ウィンドウを開かずにsand.Appを進める
+# stepsステップ進めるか、until_settledなら砂粒が止まった時点で終了する
+# recorderを渡すと毎ステップの画面を録画する（raw=Trueならグリッドのパレット番号を書く）
+def run(app, steps, schedule=None, until_settled=False, recorder=None, view=None):
+    schedule = schedule or {}
+    moves = 0
+    step = 0
+    while step < steps:
+        if step in schedule:
+            app.angle = schedule[step]
+            app.reset_errors()
+        moved = app.simulate_sand()
+        moves += moved
+        step += 1
+        if recorder is not None:
+            if recorder.raw:
+                recorder.write(view.display_grid().astype(np.uint8))     # セルの値は0～10
+            else:
+                view.record(recorder)
+        if until_settled and app.is_settled(moved):
+            break
+    return step, moves
+
+
+def make_app(division, grains, seed, **options):
+    random.seed(seed)
+    np.random.seed(seed)
+    return sand.App(division, grains, **options)
+
+
+# 1つの設定について速度とメモリを計測する
+# tracemallocは処理を遅くするので、速度を測る実行とは別に、同じシードでもう一度実行してメモリを測る
+# 並列エンジンの共有メモリやワーカープロセスはtracemallocで見えないので、peak_bytesはNoneにして
+# 共有メモリの大きさをshared_bytesに入れる
+def benchmark(division, grains, steps, schedule=None, until_settled=False, seed=0,
+              vectorized=True, track_active=True, compact=False, use_table=False, workers=0, recorder=None,
+              measure_memory=True):
+    options = dict(vectorized=vectorized, track_active=track_active, compact=compact, use_table=use_table)
+    app = make_app(division, grains, seed, **options)
+    # workersを指定したら共有メモリの並列エンジンで進める（active追跡なし）
+    engine = ParallelSand(app, workers) if workers else app
+
+    t0 = time.perf_counter()
+    done, moves = run(engine, steps, schedule, until_settled, recorder, app)
+    elapsed = time.perf_counter() - t0
+    settled = engine.is_settled(0) if until_settled else None
+    shared = None
+    if workers:
+        shared = sum(shm.size for shm in engine.shms)
+        engine.close()
+
+    peak = None
+    if measure_memory and not workers:
+        app = make_app(division, grains, seed, **options)
+        tracemalloc.start()
+        run(app, steps, schedule, until_settled)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "division": division,
+        "grains": grains,
+        "steps": done,
+        "moves": moves,
+        "seconds": elapsed,
+        "steps_per_sec": done / elapsed if elapsed else None,
+        "moves_per_sec": moves / elapsed if elapsed else None,
+        "peak_bytes": peak,
+        "shared_bytes": shared,
+        "settled": settled,
+        "state_bytes": app.grid.nbytes + app.back_grid.nbytes + app.move_states().nbytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sand.App をウィンドウなしで実行して速度を計測する")
+    parser.add_argument("--divisions", default="32,128,512,2048", help="計測するグリッドサイズ（カンマ区切り）")
+    parser.add_argument("--fill", type=float, default=0.25, help="砂粒の数をセル数に対する割合で指定")
+    parser.add_argument("--grains", type=int, default=None, help="砂粒の数（指定すると--fillより優先）")
+    parser.add_argument("--steps", type=int, default=200, help="最大ステップ数")
+    parser.add_argument("--angles", default="", help="角度スケジュール 例: 0:0,100:30,150:-30")
+    parser.add_argument("--until-settled", action="store_true", help="砂粒が止まったら終了する")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=["active", "vectorized", "loop"], default="active")
+    parser.add_argument("--compact", action="store_true", help="uint8/float32の省メモリ配置を使う")
+    parser.add_argument("--table", action="store_true", help="累積誤差の代わりに角度ごとの移動列を使う")
+    parser.add_argument("--workers", type=int, default=0, help="並列エンジンのプロセス数（0なら使わない）")
+    parser.add_argument("--output", default="bench_sand.json", help="結果を書き出すJSONファイル")
+    parser.add_argument("--skip-memory", action="store_true", help="メモリを測るための2回目の実行をしない")
+    parser.add_argument("--record", default=None, help="画面を録画する動画ファイル（グリッドサイズごとにファイル名の先頭に付ける）")
+    parser.add_argument("--record-raw", action="store_true", help="動画の代わりにパレット番号の列を書く（recorder.pyで動画にする）")
+    parser.add_argument("--policy", choices=["drop", "block"], default="block", help="録画が追いつかないときの動作")
+    args = parser.parse_args()
+    if args.workers:
+        args.mode = "vectorized"
+
+    schedule = parse_schedule(args.angles)
+    results = []
+    for division in map(int, args.divisions.split(",")):
+        grains = args.grains if args.grains is not None else int(args.fill * division * division)
+        recorder = None
+        if args.record:
+            dirname, basename = os.path.split(args.record)
+            recorder = Recorder(os.path.join(dirname, f"{division}_{basename}"), policy=args.policy, raw=args.record_raw)
+        result = benchmark(division, grains, args.steps, schedule, args.until_settled, args.seed,
+                           vectorized=args.mode != "loop", track_active=args.mode == "active",
+                           compact=args.compact, use_table=args.table, workers=args.workers, recorder=recorder,
+                           measure_memory=not args.skip_memory)
+        if recorder is not None:
+            recorder.close()
+            result["recorded_frames"] = recorder.written
+            result["dropped_frames"] = recorder.dropped
+        result["mode"] = f"parallel({args.workers})" if args.workers else args.mode
+        peak = "     n/a" if result["peak_bytes"] is None else f"{result['peak_bytes'] / 2**20:8.1f}"
+        print(f"division={division:5} grains={grains:8} steps={result['steps']:5} "
+              f"{result['steps_per_sec']:10.1f} steps/s {result['moves_per_sec']:12.1f} moves/s "
+              f"peak={peak} MiB")
+        results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "args": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
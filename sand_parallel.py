@@ -0,0 +1,150 @@
+import os
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+import sand
+
+
+# ワーカープロセス側で共有メモリを配列として開いたもの
+worker = {}
+
+
+def attach(names, shapes, dtypes, use_table):
+    worker["shms"] = [shared_memory.SharedMemory(name=name) for name in names]
+    worker["arrays"] = [np.ndarray(shape, dtype, buffer=shm.buf) for shm, shape, dtype in zip(worker["shms"], shapes, dtypes)]
+    worker["use_table"] = use_table
+    worker["tables"] = {}
+
+
+# 帯 [r0, r1) の行を1ステップ進める
+# 移動は1セルまでなので、帯の上下1行（のりしろ）の砂粒も計算すれば帯の中の移動先の取り合いを解決できる
+# 読むのは移動前の配列、書くのは移動後の配列の帯の中だけなので、帯どうしで書き込みがぶつからない
+def step_band(r0, r1, parity, angle):
+    grid_a, grid_b, states_a, states_b = worker["arrays"]
+    grid, new_grid = (grid_a, grid_b) if parity == 0 else (grid_b, grid_a)
+    states, new_states = (states_a, states_b) if parity == 0 else (states_b, states_a)
+    division = grid.shape[0]
+
+    new_grid[r0:r1] = grid[r0:r1]
+    new_states[r0:r1] = states[r0:r1]
+
+    h0, h1 = max(0, r0-1), min(division, r1+1)
+    band = grid[h0:h1]
+    rs, cs = np.nonzero((0 < band) & (band < 9))
+    rs += h0
+
+    # sand.App.next_movesと同じ計算
+    if worker["use_table"]:
+        if angle not in worker["tables"]:
+            worker["tables"][angle] = sand.move_sequence(angle)
+        table = worker["tables"][angle]
+        phases = states[rs, cs]
+        moves = table[phases]
+        stayed = carried = (phases + 1) % len(table)
+        nr, nc = rs + moves[:, 1], cs + moves[:, 0]
+    else:
+        errors = states[rs, cs] + np.array(sand.gravity_vector(angle), states.dtype)
+        moves = np.where(np.abs(errors) >= 1, np.sign(errors), 0)
+        stayed, carried = errors, errors - moves
+        nr, nc = rs + moves[:, 1].astype(int), cs + moves[:, 0].astype(int)
+
+    own = (r0 <= rs) & (rs < r1)
+    new_states[rs[own], cs[own]] = stayed[own]
+
+    movable = (0 <= nr) & (nr < division) & (0 <= nc) & (nc < division)
+    movable[movable] = grid[nr[movable], nc[movable]] == 0
+    rs, cs, nr, nc, carried = rs[movable], cs[movable], nr[movable], nc[movable], carried[movable]
+
+    # 帯の中から動いた砂粒を消す
+    own = (r0 <= rs) & (rs < r1)
+    new_grid[rs[own], cs[own]] = 0
+    new_states[rs[own], cs[own]] = 0
+
+    # 帯の中の移動先について、ラスタ順で最後の砂粒を残す
+    inside = (r0 <= nr) & (nr < r1)
+    targets = nr[inside] * division + nc[inside]
+    _, last = np.unique(targets[::-1], return_index=True)
+    winners = np.flatnonzero(inside)[len(targets) - 1 - last]
+    new_grid[nr[winners], nc[winners]] = grid[rs[winners], cs[winners]]
+    new_states[nr[winners], nc[winners]] = carried[winners]
+
+    return int(own.sum())
+
+
+# sand.Appのグリッドを共有メモリに置き、行の帯に分けて複数プロセスで進める
+# 結果はApp(track_active=False)のsimulate_sand_vectorizedと同じになる
+class ParallelSand():
+    def __init__(self, app, workers=None, bands=None):
+        self.app = app
+        self.workers = workers or os.cpu_count()
+        bands = min(bands or self.workers, app.division)
+        self.bounds = [(app.division * i // bands, app.division * (i+1) // bands) for i in range(bands)]
+
+        # グリッドと移動の状態をそれぞれ2面ずつ共有メモリに確保する
+        states = app.move_states()
+        arrays = [app.grid, app.grid, states, states]
+        self.shms = [shared_memory.SharedMemory(create=True, size=max(1, a.nbytes)) for a in arrays]
+        self.arrays = [np.ndarray(a.shape, a.dtype, buffer=shm.buf) for shm, a in zip(self.shms, arrays)]
+        for dst, src in zip(self.arrays, arrays):
+            dst[:] = src
+        self.parity = 0
+        self.expose()
+
+        self.pool = Pool(self.workers, attach, ([shm.name for shm in self.shms], [a.shape for a in arrays],
+                                                 [a.dtype for a in arrays], app.use_table))
+
+    # 現在の面をAppのgrid・誤差（位相）として見せる　show()やreset_errors()はそのまま使える
+    def expose(self):
+        grid_a, grid_b, states_a, states_b = self.arrays
+        self.app.grid, self.app.back_grid = (grid_a, grid_b) if self.parity == 0 else (grid_b, grid_a)
+        states = states_a if self.parity == 0 else states_b
+        if self.app.use_table:
+            self.app.phases = states
+        else:
+            self.app.errors = states
+
+    @property
+    def angle(self):
+        return self.app.angle
+
+    @angle.setter
+    def angle(self, value):
+        self.app.angle = value
+
+    def reset_errors(self):
+        self.app.reset_errors()
+
+    # 1ステップ進めて、動いた砂粒の数を返す
+    def simulate_sand(self):
+        tasks = [(r0, r1, self.parity, self.app.angle) for r0, r1 in self.bounds]
+        moved = sum(self.pool.starmap(step_band, tasks))
+        self.parity = 1 - self.parity
+        self.expose()
+        return moved
+
+    # sand.App.is_settledと同じく、動かなかっただけでなく全砂粒が動けないことを確かめる
+    def is_settled(self, moved):
+        return moved == 0 and self.app.all_blocked()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        # Appには共有メモリから切り離したコピーを戻す
+        grid, back_grid = self.app.grid.copy(), self.app.back_grid.copy()
+        states = self.app.move_states().copy()
+        self.app.grid, self.app.back_grid = grid, back_grid
+        if self.app.use_table:
+            self.app.phases = states
+        else:
+            self.app.errors = states
+        self.arrays = []
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,82 +1,106 @@
+import argparse
 import time
-import random
-import copy
+import numpy as np
 
 # 砂時計のサイズ
 WIDTH = 12   # 横幅
 HEIGHT = 16  # 高さ
 
-# 砂の初期配置（上半分に砂を詰める）
-def init_field():
-    field = [[0 for _ in range(WIDTH)] for _ in range(HEIGHT)]
-    # 上半分の三角形に砂を敷き詰める
-    for y in range(HEIGHT // 2):
-        for x in range(WIDTH):
-            if triangle_mask(y, x):
-                field[y][x] = 1
-    return field
+# 砂時計形状のマスク: Trueなら砂が置ける場所　形は変わらないので最初に一度だけ作る
+def make_mask(width=WIDTH, height=HEIGHT):
+    y, x = np.ogrid[:height, :width]
+    mid = width // 2
+    spread = y * width // height
+    return (mid - spread <= x) & (x <= mid + spread)
 
-# 砂時計形状のマスク: trueなら砂が置ける場所
-def triangle_mask(y, x):
-    mid = WIDTH // 2
-    spread = y * WIDTH // HEIGHT
-    return mid - spread <= x <= mid + spread
+# 砂の初期配置（上半分の三角形に砂を詰める）
+def init_field(mask):
+    field = np.zeros(mask.shape, dtype=np.uint8)
+    half = mask.shape[0] // 2
+    field[:half] = mask[:half]
+    return field
 
 # 描画
 def print_field(field):
-    for y in range(HEIGHT):
-        line = ""
-        for x in range(WIDTH):
-            line += "●" if field[y][x] == 1 else " "
-        print(line)
-    print("-" * WIDTH)
+    print("\n".join("".join(np.where(row == 1, "●", " ")) for row in field))
+    print("-" * field.shape[1])
 
 # 1ステップ分の砂の落下
-def update_field(field):
-    new_field = copy.deepcopy(field)
-    # 下から上へチェック（衝突判定のため）
-    for y in range(HEIGHT - 2, -1, -1):
-        for x in range(WIDTH):
-            if field[y][x] == 1:
-                # 真下が空いていれば落とす
-                if field[y + 1][x] == 0 and triangle_mask(y + 1, x):
-                    new_field[y][x] = 0
-                    new_field[y + 1][x] = 1
-                # 下が壁や砂なら、左右に落ちる（確率でランダム）
-                else:
-                    dirs = []
-                    if x > 0 and field[y + 1][x - 1] == 0 and triangle_mask(y + 1, x - 1):
-                        dirs.append(-1)
-                    if x < WIDTH - 1 and field[y + 1][x + 1] == 0 and triangle_mask(y + 1, x + 1):
-                        dirs.append(1)
-                    if dirs:
-                        dx = random.choice(dirs)
-                        new_field[y][x] = 0
-                        new_field[y + 1][x + dx] = 1
-    return new_field
+# fieldを読んでnew_fieldに書き（2つの配列を交互に使う）、動いた砂粒の数を返す
+# 移動先は移動前に空いているセルだけ　同じセルを取り合ったら真下に落ちる砂粒を優先し、
+# 左右から斜めに来た砂粒どうしはランダムにどちらかだけが入る（負けた砂粒はその場に残る）
+def update_field(field, new_field, mask):
+    grain = field[:-1] == 1
+    free = (field[1:] == 0) & mask[1:]     # 1つ下の行で、落ちていける空きセル
+    down = grain & free                     # 真下が空いていれば落とす
+
+    # 下が壁や砂なら、左右に落ちる（両方空いていれば確率でランダム）
+    stuck = grain & ~down
+    left = np.zeros_like(stuck)
+    right = np.zeros_like(stuck)
+    left[:, 1:] = stuck[:, 1:] & free[:, :-1]
+    right[:, :-1] = stuck[:, :-1] & free[:, 1:]
+    both = left & right
+    coin = np.random.random(both.shape) < 0.5
+    left &= ~(both & coin)
+    right &= ~(both & ~coin)
+
+    # 移動先（1つ下の行の座標）
+    to_left = np.zeros_like(stuck)
+    to_right = np.zeros_like(stuck)
+    to_left[:, :-1] = left[:, 1:]
+    to_right[:, 1:] = right[:, :-1]
+    to_left &= ~down
+    to_right &= ~down
+    clash = to_left & to_right
+    coin = np.random.random(clash.shape) < 0.5
+    to_left &= ~(clash & coin)
+    to_right &= ~(clash & ~coin)
+    left[:, 1:] = to_left[:, :-1]
+    right[:, :-1] = to_right[:, 1:]
+
+    new_field[:] = field
+    new_field[:-1][down | left | right] = 0
+    new_field[1:][down | to_left | to_right] = 1
+    return int(np.count_nonzero(down) + np.count_nonzero(to_left) + np.count_nonzero(to_right))
+
+# 上半分にある砂粒の数
+def count_top(field):
+    return int(np.count_nonzero(field[:field.shape[0] // 2]))
+
+# 上半分から出ていった砂粒の数　砂粒は1ステップで1行しか落ちず、移動先は空いていたセルだけなので、
+# 上半分の最後の行で空いたセルの数になる
+def count_crossed(field, new_field):
+    row = field.shape[0] // 2 - 1
+    return int(np.count_nonzero(field[row] > new_field[row]))
 
 # すべて下に落ちたか判定
 def is_all_down(field):
-    for y in range(HEIGHT // 2):
-        for x in range(WIDTH):
-            if field[y][x] == 1:
-                return False
-    return True
+    return count_top(field) == 0
 
-# 上下反転
+# 上下反転　コピーせずに逆順のビューを返す
 def flip_field(field):
-    flipped = [row[:] for row in field[::-1]]
-    return flipped
+    return field[::-1]
 
 if __name__ == "__main__":
-    field = init_field()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=WIDTH)
+    parser.add_argument("--height", type=int, default=HEIGHT)
+    args = parser.parse_args()
+
+    mask = make_mask(args.width, args.height)
+    field = init_field(mask)
+    new_field = np.zeros_like(field)
+    top = count_top(field)      # 上半分の砂粒の数を落ちた分だけ減らしていく
     while True:
         print_field(field)
         time.sleep(0.1)
-        new_field = update_field(field)
-        # 変化がなければ、全て落ちた扱い
-        if new_field == field and is_all_down(field):
+        moved = update_field(field, new_field, mask)
+        top -= count_crossed(field, new_field)
+        # 何も動かず上半分が空なら、全て落ちた扱い
+        if moved == 0 and top == 0:
             time.sleep(1)
             field = flip_field(field)
+            top = count_top(field)
         else:
-            field = new_field
\ No newline at end of file
+            field, new_field = new_field, field